@@ -15,9 +15,16 @@ if [[ x"$(hostname -f)" == x'vendredi.fenhl.net' ]]; then
     #TODO cargo sweep (limit to once per Rust version)
     cargo build --jobs=-1 --release --package=gefolge-web --package=gefolge-web-back
     sudo systemctl stop gefolge-web
+    sudo systemctl stop gefolge-web-back
     env -C /opt/git/github.com/dasgefolge/gefolge.org/main git --git-dir=/opt/git/github.com/dasgefolge/gefolge.org/main/.git pull
     cp target/release/gefolge-web /home/fenhl/bin/gefolge-web
     cp target/release/gefolge-web-back ~/bin/gefolge-web-back
+    psql --quiet gefolge < assets/json-version.sql
+    psql --quiet gefolge < assets/json-notify.sql
+    psql --quiet gefolge < assets/json-indexes.sql
+    psql --quiet gefolge < assets/events-index.sql
+    psql --quiet gefolge < assets/discord-outbox.sql
+    sudo systemctl start gefolge-web-back
     sudo systemctl start gefolge-web
     # restart nginx (since nginx config is tracked by git) and uWSGI
     sudo systemctl daemon-reload
@@ -0,0 +1,23 @@
+-- Discord side effects of requests, written in the same transaction as the request's other writes and sent by gefolge_web.outbox.Worker.
+-- Safe to run repeatedly. Deployed by assets/deploy.sh.
+
+CREATE TABLE IF NOT EXISTS discord_outbox (
+    id bigserial PRIMARY KEY,
+    command jsonb NOT NULL,
+    enqueued timestamptz NOT NULL DEFAULT NOW(),
+    attempts int4 NOT NULL DEFAULT 0,
+    -- NULL once the command has failed too often and won't be retried
+    next_attempt timestamptz DEFAULT NOW(),
+    last_error text
+);
+CREATE INDEX IF NOT EXISTS discord_outbox_next_attempt ON discord_outbox (next_attempt) WHERE next_attempt IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION gefolge_web_notify_outbox() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('gefolge_web_outbox', NEW.id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS gefolge_web_notify_outbox ON discord_outbox;
+CREATE TRIGGER gefolge_web_notify_outbox AFTER INSERT ON discord_outbox FOR EACH ROW EXECUTE FUNCTION gefolge_web_notify_outbox();
@@ -0,0 +1,88 @@
+-- Keeps a typed index of the fields of events that are used for ordering and filtering, see gefolge_web.event.model.Event.select.
+-- The index is maintained by triggers so that writes from the Discord bot and the Rust code are reflected too.
+-- Safe to run repeatedly. Deployed by assets/deploy.sh.
+
+CREATE TABLE IF NOT EXISTS events_index (
+    id text PRIMARY KEY REFERENCES json_events (id) ON DELETE CASCADE,
+    start_time timestamptz,
+    end_time timestamptz,
+    timezone text NOT NULL,
+    location text,
+    signups int8[] NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_index_start ON events_index (start_time, end_time);
+CREATE INDEX IF NOT EXISTS events_index_end ON events_index (end_time);
+CREATE INDEX IF NOT EXISTS events_index_signups ON events_index USING GIN (signups);
+
+-- same as gefolge_web.util.parse_iso_datetime: timestamps without an offset are local to the event's timezone
+-- malformed timestamps and unknown timezones are indexed as NULL, since failing here would make the write to json_events fail
+CREATE OR REPLACE FUNCTION gefolge_web_event_time(value text, tz text) RETURNS timestamptz AS $$
+BEGIN
+    IF value IS NULL THEN
+        RETURN NULL;
+    ELSIF value ~ '(Z|[+-][0-9]{2}(:?[0-9]{2})?)$' THEN
+        RETURN value::timestamptz;
+    ELSE
+        RETURN value::timestamp AT TIME ZONE tz;
+    END IF;
+EXCEPTION WHEN data_exception THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- same as gefolge_web.event.model.Event.timezone
+CREATE OR REPLACE FUNCTION gefolge_web_event_timezone(value jsonb) RETURNS text AS $$
+    SELECT COALESCE(
+        value ->> 'timezone',
+        (SELECT json_locations.value ->> 'timezone' FROM json_locations WHERE json_locations.id = value ->> 'location'),
+        'Europe/Berlin'
+    );
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION gefolge_web_index_event(event_id text) RETURNS void AS $$
+    INSERT INTO events_index (id, start_time, end_time, timezone, location, signups)
+    SELECT
+        id,
+        gefolge_web_event_time(value ->> 'start', gefolge_web_event_timezone(value)),
+        gefolge_web_event_time(value ->> 'end', gefolge_web_event_timezone(value)),
+        gefolge_web_event_timezone(value),
+        value ->> 'location',
+        -- everyone with a signup date, see gefolge_web.event.model.Event.signup_ids
+        ARRAY(SELECT DISTINCT (mensch ->> 'id')::int8 FROM jsonb_array_elements(COALESCE(value -> 'menschen', '[]')) AS mensch WHERE mensch ? 'signup' AND mensch ->> 'id' ~ '^[0-9]{1,18}$')
+    FROM json_events
+    WHERE id = event_id
+    ON CONFLICT (id) DO UPDATE SET
+        start_time = EXCLUDED.start_time,
+        end_time = EXCLUDED.end_time,
+        timezone = EXCLUDED.timezone,
+        location = EXCLUDED.location,
+        signups = EXCLUDED.signups;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION gefolge_web_index_events() RETURNS trigger AS $$
+BEGIN
+    PERFORM gefolge_web_index_event(NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- the timezone of a location determines the times of events there which don't have their own timezone
+CREATE OR REPLACE FUNCTION gefolge_web_index_location_events() RETURNS trigger AS $$
+BEGIN
+    PERFORM gefolge_web_index_event(id) FROM json_events WHERE value ->> 'location' = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS gefolge_web_index_events ON json_events;
+CREATE TRIGGER gefolge_web_index_events AFTER INSERT OR UPDATE ON json_events FOR EACH ROW EXECUTE FUNCTION gefolge_web_index_events();
+
+DROP TRIGGER IF EXISTS gefolge_web_index_location_events ON json_locations;
+CREATE TRIGGER gefolge_web_index_location_events AFTER INSERT OR UPDATE ON json_locations FOR EACH ROW EXECUTE FUNCTION gefolge_web_index_location_events();
+
+-- index events that were written before the triggers existed
+DO $$
+BEGIN
+    PERFORM gefolge_web_index_event(id) FROM json_events;
+END;
+$$;
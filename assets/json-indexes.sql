@@ -0,0 +1,7 @@
+-- Indexes on fields of JSON rows. Safe to run repeatedly. Deployed by assets/deploy.sh.
+
+-- used by `gefolge-web-back user-id-by-api-key` and API authentication in the Rust code
+CREATE UNIQUE INDEX IF NOT EXISTS json_user_data_api_key ON json_user_data ((value -> 'apiKey'));
+
+-- replaced by the signups column of events_index, see assets/events-index.sql
+DROP INDEX IF EXISTS json_events_menschen;
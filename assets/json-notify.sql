@@ -0,0 +1,24 @@
+-- Notifies gefolge-web workers of changes to rows they may have cached, see gefolge_web.db.SharedCache.
+-- Safe to run repeatedly. Deployed by assets/deploy.sh.
+
+CREATE OR REPLACE FUNCTION gefolge_web_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('gefolge_web_rows', json_build_object(
+        'table', TG_ARGV[0],
+        'id', CASE WHEN TG_OP = 'DELETE' THEN to_jsonb(OLD) ELSE to_jsonb(NEW) END ->> TG_ARGV[1]
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS gefolge_web_notify ON json_events;
+CREATE TRIGGER gefolge_web_notify AFTER INSERT OR UPDATE OR DELETE ON json_events FOR EACH ROW EXECUTE FUNCTION gefolge_web_notify('events', 'id');
+
+DROP TRIGGER IF EXISTS gefolge_web_notify ON json_locations;
+CREATE TRIGGER gefolge_web_notify AFTER INSERT OR UPDATE OR DELETE ON json_locations FOR EACH ROW EXECUTE FUNCTION gefolge_web_notify('locations', 'id');
+
+DROP TRIGGER IF EXISTS gefolge_web_notify ON json_user_data;
+CREATE TRIGGER gefolge_web_notify AFTER INSERT OR UPDATE OR DELETE ON json_user_data FOR EACH ROW EXECUTE FUNCTION gefolge_web_notify('user-data', 'id');
+
+DROP TRIGGER IF EXISTS gefolge_web_notify ON users;
+CREATE TRIGGER gefolge_web_notify AFTER INSERT OR UPDATE OR DELETE ON users FOR EACH ROW EXECUTE FUNCTION gefolge_web_notify('profiles', 'snowflake');
@@ -0,0 +1,23 @@
+-- Adds a version to each JSON row, which gefolge-web uses to detect concurrent modifications, see gefolge_web.db.Batch.
+-- The version is incremented by a trigger so that writes from the Discord bot and the Rust code are detected too.
+-- Safe to run repeatedly. Deployed by assets/deploy.sh.
+
+ALTER TABLE json_events ADD COLUMN IF NOT EXISTS version int8 NOT NULL DEFAULT 0;
+ALTER TABLE json_locations ADD COLUMN IF NOT EXISTS version int8 NOT NULL DEFAULT 0;
+ALTER TABLE json_user_data ADD COLUMN IF NOT EXISTS version int8 NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION gefolge_web_bump_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS gefolge_web_bump_version ON json_events;
+CREATE TRIGGER gefolge_web_bump_version BEFORE UPDATE ON json_events FOR EACH ROW WHEN (OLD.value IS DISTINCT FROM NEW.value) EXECUTE FUNCTION gefolge_web_bump_version();
+
+DROP TRIGGER IF EXISTS gefolge_web_bump_version ON json_locations;
+CREATE TRIGGER gefolge_web_bump_version BEFORE UPDATE ON json_locations FOR EACH ROW WHEN (OLD.value IS DISTINCT FROM NEW.value) EXECUTE FUNCTION gefolge_web_bump_version();
+
+DROP TRIGGER IF EXISTS gefolge_web_bump_version ON json_user_data;
+CREATE TRIGGER gefolge_web_bump_version BEFORE UPDATE ON json_user_data FOR EACH ROW WHEN (OLD.value IS DISTINCT FROM NEW.value) EXECUTE FUNCTION gefolge_web_bump_version();
@@ -5,27 +5,54 @@ use {
     std::{
         collections::BTreeSet,
         fmt,
-        io::stdout,
+        io::{
+            self,
+            stdin,
+            stdout,
+        },
+        path::PathBuf,
         str::FromStr as _,
     },
     chrono::prelude::*,
-    futures::stream::TryStreamExt as _,
-    serde::Serialize,
+    serde::{
+        Deserialize,
+        Serialize,
+    },
     serde_json::Value as Json,
     serde_plain::derive_serialize_from_display,
     serenity::model::prelude::*,
     sqlx::{
         PgPool,
+        Row as _,
         postgres::PgConnectOptions,
     },
+    tokio::{
+        fs,
+        io::{
+            AsyncBufReadExt as _,
+            AsyncWriteExt as _,
+            BufReader,
+        },
+        net::{
+            UnixListener,
+            UnixStream,
+        },
+    },
 };
 
 #[derive(clap::Subcommand)]
 enum StringDbSubcommand {
-    List,
+    List {
+        /// Print a JSON object mapping each ID to its value instead of just the IDs.
+        #[clap(long)]
+        with_values: bool,
+    },
     Get {
         id: String,
     },
+    GetMany {
+        ids: Vec<String>,
+    },
     Set {
         id: String,
         #[clap(value_parser = Json::from_str)]
@@ -38,12 +65,32 @@ enum StringDbSubcommand {
     },
 }
 
+impl StringDbSubcommand {
+    fn into_request(self, table: Table) -> Request {
+        match self {
+            Self::List { with_values: false } => Request::List { table },
+            Self::List { with_values: true } => Request::GetMany { table, ids: None },
+            Self::Get { id } => Request::Get { table, id },
+            Self::GetMany { ids } => Request::GetMany { table, ids: Some(ids) },
+            Self::Set { id, value } => Request::Set { table, id, value },
+            Self::SetIfNotExists { id, value } => Request::SetIfNotExists { table, id, value },
+        }
+    }
+}
+
 #[derive(clap::Subcommand)]
 enum UserIdDbSubcommand {
-    List,
+    List {
+        /// Print a JSON object mapping each ID to its value instead of just the IDs.
+        #[clap(long)]
+        with_values: bool,
+    },
     Get {
         id: UserId,
     },
+    GetMany {
+        ids: Vec<UserId>,
+    },
     Set {
         id: UserId,
         #[clap(value_parser = Json::from_str)]
@@ -56,6 +103,19 @@ enum UserIdDbSubcommand {
     },
 }
 
+impl UserIdDbSubcommand {
+    fn into_request(self, table: Table) -> Request {
+        match self {
+            Self::List { with_values: false } => Request::List { table },
+            Self::List { with_values: true } => Request::GetMany { table, ids: None },
+            Self::Get { id } => Request::Get { table, id: id.to_string() },
+            Self::GetMany { ids } => Request::GetMany { table, ids: Some(ids.iter().map(UserId::to_string).collect()) },
+            Self::Set { id, value } => Request::Set { table, id: id.to_string(), value },
+            Self::SetIfNotExists { id, value } => Request::SetIfNotExists { table, id: id.to_string(), value },
+        }
+    }
+}
+
 struct Discriminator(i16);
 
 impl fmt::Display for Discriminator {
@@ -76,9 +136,137 @@ struct Profile {
     username: String,
 }
 
+#[derive(Clone, Copy, Deserialize)]
+#[serde(rename_all = "kebab-case")]
+enum Table {
+    Events,
+    Locations,
+    Profiles,
+    UserData,
+}
+
+#[derive(Deserialize)]
+#[serde(tag = "op", rename_all = "kebab-case")]
+enum PatchOp {
+    /// Sets the value at the given path. The parent of the path must already exist. An empty path replaces the whole document, creating the row if necessary.
+    Set {
+        path: Vec<String>,
+        value: Json,
+    },
+    Delete {
+        path: Vec<String>,
+    },
+    /// Appends the given values to the array at the given path.
+    Append {
+        path: Vec<String>,
+        values: Vec<Json>,
+    },
+}
+
+#[derive(Deserialize)]
+struct Patch {
+    table: Table,
+    id: String,
+    /// The version of the row the patch is based on, or `None` if it's based on the row not existing. The patch fails with a conflict if the row has a different version.
+    version: Option<i64>,
+    ops: Vec<PatchOp>,
+}
+
+/// A request as sent to the daemon, one JSON object per line.
+#[derive(Deserialize)]
+#[serde(tag = "cmd", rename_all = "kebab-case")]
+enum Request {
+    List {
+        table: Table,
+    },
+    Get {
+        table: Table,
+        id: String,
+    },
+    /// Returns a JSON object mapping IDs to values. Rows that don't exist are omitted. If `ids` is omitted, all rows are returned.
+    GetMany {
+        table: Table,
+        #[serde(default)]
+        ids: Option<Vec<String>>,
+    },
+    /// Like `Get`, but returns an object with the fields `value` and `version`. Profiles are not versioned and always have version 0.
+    GetVersioned {
+        table: Table,
+        id: String,
+    },
+    /// Like `GetMany`, but the values are objects with the fields `value` and `version`.
+    GetManyVersioned {
+        table: Table,
+        #[serde(default)]
+        ids: Option<Vec<String>>,
+    },
+    Set {
+        table: Table,
+        id: String,
+        value: Json,
+    },
+    SetIfNotExists {
+        table: Table,
+        id: String,
+        value: Json,
+    },
+    /// Applies all of the given patches in a single transaction. The given Discord commands are added to the outbox from assets/discord-outbox.sql in the same transaction.
+    PatchMany {
+        patches: Vec<Patch>,
+        #[serde(default)]
+        outbox: Vec<Json>,
+    },
+    /// Returns the ID of the user-data row with the given API key. Uses the index from assets/json-indexes.sql.
+    UserIdByApiKey {
+        api_key: String,
+    },
+    /// Returns the IDs of events in chronological order, optionally only upcoming (`true`) or past (`false`) events, or those the given user or guest has signed up for. Uses the table from assets/events-index.sql.
+    EventIds {
+        #[serde(default)]
+        upcoming: Option<bool>,
+        #[serde(default)]
+        attendee: Option<String>,
+    },
+}
+
+/// A response as sent by the daemon, one JSON value per line, in the same order as the requests.
+#[derive(Serialize)]
+#[serde(rename_all = "camelCase")]
+enum Response {
+    Ok(Json),
+    NotFound,
+    /// A patch was based on an outdated version of a row. None of the patches were applied.
+    Conflict,
+    /// A patch would have violated a unique index, e.g. by reusing an API key. None of the patches were applied.
+    UniqueViolation,
+    Error(String),
+}
+
 #[derive(clap::Parser)]
 #[clap(version)]
 enum Args {
+    /// Keep a database connection pool open and answer requests on the given Unix socket.
+    Daemon {
+        socket: PathBuf,
+    },
+    /// Read a single request in the daemon's format from stdin and print the response.
+    Request,
+    /// Print the Discord snowflake of the user with the given API key.
+    UserIdByApiKey {
+        api_key: String,
+    },
+    /// Print the IDs of events in chronological order.
+    EventIds {
+        /// Only events which haven't ended yet.
+        #[clap(long, conflicts_with = "past")]
+        upcoming: bool,
+        /// Only events which have ended.
+        #[clap(long)]
+        past: bool,
+        /// Only events the user or guest with the given ID has signed up for.
+        #[clap(long)]
+        attendee: Option<String>,
+    },
     #[clap(subcommand)]
     Events(StringDbSubcommand),
     #[clap(subcommand)]
@@ -91,82 +279,158 @@ enum Args {
 
 #[derive(Debug, thiserror::Error)]
 enum Error {
+    #[error(transparent)] Io(#[from] io::Error),
     #[error(transparent)] Json(#[from] serde_json::Error),
+    #[error(transparent)] ParseInt(#[from] std::num::ParseIntError),
     #[error(transparent)] Sql(#[from] sqlx::Error),
     #[error("a JSON argument did not match the expected format")]
     JsonFormat,
+    #[error("a row was modified concurrently")]
+    Conflict,
+    #[error("a value that must be unique is already in use")]
+    UniqueViolation,
+    #[error("profiles can only be replaced as a whole since they're not stored as JSON")]
+    PatchProfiles,
 }
 
-#[wheel::main(debug)]
-async fn main(args: Args) -> Result<i32, Error> {
-    let db_pool = PgPool::connect_with(PgConnectOptions::default().username("fenhl").database("gefolge").application_name("gefolge-web-back")).await?;
-    match args {
-        Args::Events(StringDbSubcommand::List) => {
-            let mut events = sqlx::query_scalar!("SELECT id FROM json_events").fetch(&db_pool);
-            while let Some(id) = events.try_next().await? {
-                println!("{id}");
-            }
-        }
-        Args::Events(StringDbSubcommand::Get { id }) => if let Some(value) = sqlx::query_scalar!("SELECT value FROM json_events WHERE id = $1", id).fetch_optional(&db_pool).await? {
-            serde_json::to_writer(stdout(), &value)?;
+fn user_id(id: &str) -> Result<UserId, Error> {
+    Ok(UserId::new(id.parse()?))
+}
+
+fn user_ids(ids: Option<Vec<String>>) -> Result<Option<Vec<i64>>, Error> {
+    ids.map(|ids| ids.iter().map(|id| Ok(i64::from(user_id(id)?))).collect()).transpose()
+}
+
+/// Locks the row and checks that it has the given version, or creates an empty row if the version is `None`.
+async fn check_version(transaction: &mut sqlx::Transaction<'_, sqlx::Postgres>, table: Table, id: &str, version: Option<i64>) -> Result<(), Error> {
+    let query = sqlx::query(match (table, version) {
+        (Table::Profiles, _) => return Err(Error::PatchProfiles),
+        (Table::Events, Some(_)) => "SELECT version FROM json_events WHERE id = $1 FOR UPDATE",
+        (Table::Events, None) => "INSERT INTO json_events (id, value) VALUES ($1, '{}') ON CONFLICT (id) DO NOTHING RETURNING version",
+        (Table::Locations, Some(_)) => "SELECT version FROM json_locations WHERE id = $1 FOR UPDATE",
+        (Table::Locations, None) => "INSERT INTO json_locations (id, value) VALUES ($1, '{}') ON CONFLICT (id) DO NOTHING RETURNING version",
+        (Table::UserData, Some(_)) => "SELECT version FROM json_user_data WHERE id = $1 FOR UPDATE",
+        (Table::UserData, None) => "INSERT INTO json_user_data (id, value) VALUES ($1, '{}') ON CONFLICT (id) DO NOTHING RETURNING version",
+    });
+    let query = if let Table::UserData = table { query.bind(i64::from(user_id(id)?)) } else { query.bind(id) };
+    let row = query.fetch_optional(&mut **transaction).await?;
+    match (version, row) {
+        // the row was created by us
+        (None, Some(_)) => Ok(()),
+        (Some(version), Some(row)) if row.try_get::<i64, _>("version")? == version => Ok(()),
+        (_, _) => Err(Error::Conflict),
+    }
+}
+
+async fn apply_patch_op(transaction: &mut sqlx::Transaction<'_, sqlx::Postgres>, table: Table, id: &str, op: PatchOp) -> Result<(), Error> {
+    let query = sqlx::query(match (table, &op) {
+        (Table::Profiles, _) => return Err(Error::PatchProfiles),
+        (Table::Events, PatchOp::Set { path, .. }) if path.is_empty() => "INSERT INTO json_events (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value",
+        (Table::Events, PatchOp::Set { .. }) => "UPDATE json_events SET value = JSONB_SET(value, $2, $3) WHERE id = $1",
+        (Table::Events, PatchOp::Delete { .. }) => "UPDATE json_events SET value = value #- $2 WHERE id = $1",
+        (Table::Events, PatchOp::Append { .. }) => "UPDATE json_events SET value = JSONB_SET(value, $2, COALESCE(value #> $2, '[]') || $3) WHERE id = $1",
+        (Table::Locations, PatchOp::Set { path, .. }) if path.is_empty() => "INSERT INTO json_locations (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value",
+        (Table::Locations, PatchOp::Set { .. }) => "UPDATE json_locations SET value = JSONB_SET(value, $2, $3) WHERE id = $1",
+        (Table::Locations, PatchOp::Delete { .. }) => "UPDATE json_locations SET value = value #- $2 WHERE id = $1",
+        (Table::Locations, PatchOp::Append { .. }) => "UPDATE json_locations SET value = JSONB_SET(value, $2, COALESCE(value #> $2, '[]') || $3) WHERE id = $1",
+        (Table::UserData, PatchOp::Set { path, .. }) if path.is_empty() => "INSERT INTO json_user_data (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value",
+        (Table::UserData, PatchOp::Set { .. }) => "UPDATE json_user_data SET value = JSONB_SET(value, $2, $3) WHERE id = $1",
+        (Table::UserData, PatchOp::Delete { .. }) => "UPDATE json_user_data SET value = value #- $2 WHERE id = $1",
+        (Table::UserData, PatchOp::Append { .. }) => "UPDATE json_user_data SET value = JSONB_SET(value, $2, COALESCE(value #> $2, '[]') || $3) WHERE id = $1",
+    });
+    let query = if let Table::UserData = table { query.bind(i64::from(user_id(id)?)) } else { query.bind(id) };
+    let query = match op {
+        PatchOp::Set { path, value } if path.is_empty() => query.bind(value),
+        PatchOp::Set { path, value } => query.bind(path).bind(value),
+        PatchOp::Delete { path } => query.bind(path),
+        PatchOp::Append { path, values } => query.bind(path).bind(Json::Array(values)),
+    };
+    match query.execute(&mut **transaction).await {
+        Ok(_) => Ok(()),
+        // e.g. an API key that was given to someone else concurrently, see assets/json-indexes.sql
+        Err(sqlx::Error::Database(e)) if e.is_unique_violation() => Err(Error::UniqueViolation),
+        Err(e) => Err(e.into()),
+    }
+}
+
+/// Overwrites the given profile. Profiles aren't stored as JSON, so they can't be patched.
+async fn upsert_profile(executor: impl sqlx::PgExecutor<'_>, id: &str, value: Json) -> Result<(), Error> {
+    let Json::Object(mut value) = value else { return Err(Error::JsonFormat) };
+    sqlx::query!("
+        INSERT INTO users
+        (snowflake, discriminator, joined, nick, roles, username)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (snowflake) DO UPDATE SET
+        discriminator = EXCLUDED.discriminator,
+        joined = EXCLUDED.joined,
+        nick = EXCLUDED.nick,
+        roles = EXCLUDED.roles,
+        username = EXCLUDED.username
+    ",
+        i64::from(user_id(id)?),
+        value.remove("discriminator").and_then(|discrim| serde_json::from_value::<Option<i16>>(discrim).transpose()).transpose()?,
+        value.remove("joined").and_then(|joined| serde_json::from_value::<Option<DateTime<Utc>>>(joined).transpose()).transpose()?,
+        value.remove("nick").and_then(|nick| serde_json::from_value::<Option<String>>(nick).transpose()).transpose()?,
+        value.remove("roles").unwrap_or_default(),
+        serde_json::from_value::<String>(value.remove("username").ok_or(Error::JsonFormat)?)?,
+    ).execute(executor).await?;
+    Ok(())
+}
+
+/// Returns `Ok(None)` if the requested row does not exist.
+async fn handle(db_pool: &PgPool, request: Request) -> Result<Option<Json>, Error> {
+    Ok(Some(match request {
+        Request::List { table: Table::Events } => Json::Array(sqlx::query_scalar!("SELECT id FROM json_events").fetch_all(db_pool).await?.into_iter().map(Json::String).collect()),
+        Request::Get { table: Table::Events, id } => if let Some(value) = sqlx::query_scalar!("SELECT value FROM json_events WHERE id = $1", id).fetch_optional(db_pool).await? {
+            value
         } else {
-            return Ok(2)
+            return Ok(None)
         },
-        Args::Events(StringDbSubcommand::Set { id, value }) => { sqlx::query!("INSERT INTO json_events (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value", id, value).execute(&db_pool).await?; }
-        Args::Events(StringDbSubcommand::SetIfNotExists { id, value }) => { sqlx::query!("INSERT INTO json_events (id, value) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING", id, value).execute(&db_pool).await?; }
-        Args::Locations(StringDbSubcommand::List) => {
-            let mut locations = sqlx::query_scalar!("SELECT id FROM json_locations").fetch(&db_pool);
-            while let Some(id) = locations.try_next().await? {
-                println!("{id}");
-            }
-        }
-        Args::Locations(StringDbSubcommand::Get { id }) => if let Some(value) = sqlx::query_scalar!("SELECT value FROM json_locations WHERE id = $1", id).fetch_optional(&db_pool).await? {
-            serde_json::to_writer(stdout(), &value)?;
+        Request::GetMany { table: Table::Events, ids } => Json::Object(sqlx::query_as::<_, (String, Json)>("SELECT id, value FROM json_events WHERE $1::text[] IS NULL OR id = ANY($1)").bind(ids).fetch_all(db_pool).await?.into_iter().collect()),
+        Request::Set { table: Table::Events, id, value } => { sqlx::query!("INSERT INTO json_events (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value", id, value).execute(db_pool).await?; Json::Null }
+        Request::SetIfNotExists { table: Table::Events, id, value } => { sqlx::query!("INSERT INTO json_events (id, value) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING", id, value).execute(db_pool).await?; Json::Null }
+        Request::List { table: Table::Locations } => Json::Array(sqlx::query_scalar!("SELECT id FROM json_locations").fetch_all(db_pool).await?.into_iter().map(Json::String).collect()),
+        Request::Get { table: Table::Locations, id } => if let Some(value) = sqlx::query_scalar!("SELECT value FROM json_locations WHERE id = $1", id).fetch_optional(db_pool).await? {
+            value
         } else {
-            return Ok(2)
+            return Ok(None)
         },
-        Args::Locations(StringDbSubcommand::Set { id, value }) => { sqlx::query!("INSERT INTO json_locations (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value", id, value).execute(&db_pool).await?; }
-        Args::Locations(StringDbSubcommand::SetIfNotExists { id, value }) => { sqlx::query!("INSERT INTO json_locations (id, value) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING", id, value).execute(&db_pool).await?; }
-        Args::Profiles(UserIdDbSubcommand::List) => {
-            let mut profiles = sqlx::query_scalar!("SELECT snowflake FROM users").fetch(&db_pool);
-            while let Some(id) = profiles.try_next().await? {
-                println!("{}", id as u64);
+        Request::GetMany { table: Table::Locations, ids } => Json::Object(sqlx::query_as::<_, (String, Json)>("SELECT id, value FROM json_locations WHERE $1::text[] IS NULL OR id = ANY($1)").bind(ids).fetch_all(db_pool).await?.into_iter().collect()),
+        Request::Set { table: Table::Locations, id, value } => { sqlx::query!("INSERT INTO json_locations (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value", id, value).execute(db_pool).await?; Json::Null }
+        Request::SetIfNotExists { table: Table::Locations, id, value } => { sqlx::query!("INSERT INTO json_locations (id, value) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING", id, value).execute(db_pool).await?; Json::Null }
+        Request::List { table: Table::Profiles } => Json::Array(sqlx::query_scalar!("SELECT snowflake FROM users").fetch_all(db_pool).await?.into_iter().map(|id| Json::String((id as u64).to_string())).collect()),
+        Request::Get { table: Table::Profiles, id } => {
+            let id = user_id(&id)?;
+            if let Some(row) = sqlx::query!(r#"SELECT discriminator, joined, nick, roles AS "roles: sqlx::types::Json<BTreeSet<RoleId>>", username FROM users WHERE snowflake = $1"#, i64::from(id)).fetch_optional(db_pool).await? {
+                serde_json::to_value(Profile {
+                    discriminator: row.discriminator.map(Discriminator),
+                    joined: row.joined,
+                    nick: row.nick,
+                    roles: row.roles.0,
+                    snowflake: id,
+                    username: row.username,
+                })?
+            } else {
+                return Ok(None)
             }
         }
-        Args::Profiles(UserIdDbSubcommand::Get { id }) => if let Some(row) = sqlx::query!(r#"SELECT discriminator, joined, nick, roles AS "roles: sqlx::types::Json<BTreeSet<RoleId>>", username FROM users WHERE snowflake = $1"#, i64::from(id)).fetch_optional(&db_pool).await? {
-            serde_json::to_writer(stdout(), &Profile {
-                discriminator: row.discriminator.map(Discriminator),
-                joined: row.joined,
-                nick: row.nick,
-                roles: row.roles.0,
-                snowflake: id,
-                username: row.username,
-            })?;
-        } else {
-            return Ok(2)
-        },
-        Args::Profiles(UserIdDbSubcommand::Set { id, value }) => {
-            let Json::Object(mut value) = value else { return Err(Error::JsonFormat) };
-            sqlx::query!("
-                INSERT INTO users
-                (snowflake, discriminator, joined, nick, roles, username)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                ON CONFLICT (snowflake) DO UPDATE SET
-                discriminator = EXCLUDED.discriminator,
-                joined = EXCLUDED.joined,
-                nick = EXCLUDED.nick,
-                roles = EXCLUDED.roles,
-                username = EXCLUDED.username
-            ",
-                i64::from(id),
-                value.remove("discriminator").and_then(|discrim| serde_json::from_value::<Option<i16>>(discrim).transpose()).transpose()?,
-                value.remove("joined").and_then(|joined| serde_json::from_value::<Option<DateTime<Utc>>>(joined).transpose()).transpose()?,
-                value.remove("nick").and_then(|nick| serde_json::from_value::<Option<String>>(nick).transpose()).transpose()?,
-                value.remove("roles").unwrap_or_default(),
-                serde_json::from_value::<String>(value.remove("username").ok_or(Error::JsonFormat)?)?,
-            ).execute(&db_pool).await?;
+        Request::GetMany { table: Table::Profiles, ids } => {
+            let mut profiles = serde_json::Map::default();
+            for row in sqlx::query("SELECT snowflake, discriminator, joined, nick, roles, username FROM users WHERE $1::int8[] IS NULL OR snowflake = ANY($1)").bind(user_ids(ids)?).fetch_all(db_pool).await? {
+                let snowflake = UserId::new(row.try_get::<i64, _>("snowflake")? as u64);
+                profiles.insert(snowflake.to_string(), serde_json::to_value(Profile {
+                    discriminator: row.try_get::<Option<i16>, _>("discriminator")?.map(Discriminator),
+                    joined: row.try_get("joined")?,
+                    nick: row.try_get("nick")?,
+                    roles: row.try_get::<sqlx::types::Json<BTreeSet<RoleId>>, _>("roles")?.0,
+                    snowflake,
+                    username: row.try_get("username")?,
+                })?);
+            }
+            Json::Object(profiles)
         }
-        Args::Profiles(UserIdDbSubcommand::SetIfNotExists { id, value }) => {
+        Request::Set { table: Table::Profiles, id, value } => { upsert_profile(db_pool, &id, value).await?; Json::Null }
+        Request::SetIfNotExists { table: Table::Profiles, id, value } => {
             let Json::Object(mut value) = value else { return Err(Error::JsonFormat) };
             sqlx::query!("
                 INSERT INTO users
@@ -174,27 +438,178 @@ async fn main(args: Args) -> Result<i32, Error> {
                 VALUES ($1, $2, $3, $4, $5, $6)
                 ON CONFLICT (snowflake) DO NOTHING
             ",
-                i64::from(id),
+                i64::from(user_id(&id)?),
                 value.remove("discriminator").and_then(|discrim| serde_json::from_value::<Option<i16>>(discrim).transpose()).transpose()?,
                 value.remove("joined").and_then(|joined| serde_json::from_value::<Option<DateTime<Utc>>>(joined).transpose()).transpose()?,
                 value.remove("nick").and_then(|nick| serde_json::from_value::<Option<String>>(nick).transpose()).transpose()?,
                 value.remove("roles").unwrap_or_default(),
                 serde_json::from_value::<String>(value.remove("username").ok_or(Error::JsonFormat)?)?,
-            ).execute(&db_pool).await?;
+            ).execute(db_pool).await?;
+            Json::Null
         }
-        Args::UserData(UserIdDbSubcommand::List) => {
-            let mut user_data = sqlx::query_scalar!("SELECT id FROM json_user_data").fetch(&db_pool);
-            while let Some(id) = user_data.try_next().await? {
-                println!("{}", id as u64);
+        Request::List { table: Table::UserData } => Json::Array(sqlx::query_scalar!("SELECT id FROM json_user_data").fetch_all(db_pool).await?.into_iter().map(|id| Json::String((id as u64).to_string())).collect()),
+        Request::Get { table: Table::UserData, id } => if let Some(value) = sqlx::query_scalar!("SELECT value FROM json_user_data WHERE id = $1", i64::from(user_id(&id)?)).fetch_optional(db_pool).await? {
+            value
+        } else {
+            return Ok(None)
+        },
+        Request::GetMany { table: Table::UserData, ids } => Json::Object(sqlx::query_as::<_, (i64, Json)>("SELECT id, value FROM json_user_data WHERE $1::int8[] IS NULL OR id = ANY($1)").bind(user_ids(ids)?).fetch_all(db_pool).await?.into_iter().map(|(id, value)| ((id as u64).to_string(), value)).collect()),
+        Request::Set { table: Table::UserData, id, value } => { sqlx::query!("INSERT INTO json_user_data (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value", i64::from(user_id(&id)?), value).execute(db_pool).await?; Json::Null }
+        Request::SetIfNotExists { table: Table::UserData, id, value } => { sqlx::query!("INSERT INTO json_user_data (id, value) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING", i64::from(user_id(&id)?), value).execute(db_pool).await?; Json::Null }
+        Request::GetVersioned { table: Table::Profiles, id } => if let Some(value) = Box::pin(handle(db_pool, Request::Get { table: Table::Profiles, id })).await? {
+            versioned(value, 0)
+        } else {
+            return Ok(None)
+        },
+        Request::GetVersioned { table, id } => {
+            let query = sqlx::query_as::<_, (Json, i64)>(match table {
+                Table::Events => "SELECT value, version FROM json_events WHERE id = $1",
+                Table::Locations => "SELECT value, version FROM json_locations WHERE id = $1",
+                Table::Profiles => unreachable!(),
+                Table::UserData => "SELECT value, version FROM json_user_data WHERE id = $1",
+            });
+            let query = if let Table::UserData = table { query.bind(i64::from(user_id(&id)?)) } else { query.bind(id) };
+            if let Some((value, version)) = query.fetch_optional(db_pool).await? {
+                versioned(value, version)
+            } else {
+                return Ok(None)
             }
         }
-        Args::UserData(UserIdDbSubcommand::Get { id }) => if let Some(value) = sqlx::query_scalar!("SELECT value FROM json_user_data WHERE id = $1", i64::from(id)).fetch_optional(&db_pool).await? {
-            serde_json::to_writer(stdout(), &value)?;
+        Request::GetManyVersioned { table: Table::Profiles, ids } => {
+            let Some(Json::Object(profiles)) = Box::pin(handle(db_pool, Request::GetMany { table: Table::Profiles, ids })).await? else { unreachable!() };
+            Json::Object(profiles.into_iter().map(|(id, value)| (id, versioned(value, 0))).collect())
+        }
+        Request::GetManyVersioned { table: Table::UserData, ids } => Json::Object(
+            sqlx::query_as::<_, (i64, Json, i64)>("SELECT id, value, version FROM json_user_data WHERE $1::int8[] IS NULL OR id = ANY($1)").bind(user_ids(ids)?).fetch_all(db_pool).await?
+                .into_iter()
+                .map(|(id, value, version)| ((id as u64).to_string(), versioned(value, version)))
+                .collect()
+        ),
+        Request::GetManyVersioned { table, ids } => Json::Object(
+            sqlx::query_as::<_, (String, Json, i64)>(match table {
+                Table::Events => "SELECT id, value, version FROM json_events WHERE $1::text[] IS NULL OR id = ANY($1)",
+                Table::Locations => "SELECT id, value, version FROM json_locations WHERE $1::text[] IS NULL OR id = ANY($1)",
+                Table::Profiles | Table::UserData => unreachable!(),
+            }).bind(ids).fetch_all(db_pool).await?
+                .into_iter()
+                .map(|(id, value, version)| (id, versioned(value, version)))
+                .collect()
+        ),
+        Request::UserIdByApiKey { api_key } => if let Some(id) = sqlx::query_scalar::<_, i64>("SELECT id FROM json_user_data WHERE value -> 'apiKey' = $1").bind(sqlx::types::Json(api_key)).fetch_optional(db_pool).await? {
+            Json::String((id as u64).to_string())
         } else {
-            return Ok(2)
+            return Ok(None)
         },
-        Args::UserData(UserIdDbSubcommand::Set { id, value }) => { sqlx::query!("INSERT INTO json_user_data (id, value) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value", i64::from(id), value).execute(&db_pool).await?; }
-        Args::UserData(UserIdDbSubcommand::SetIfNotExists { id, value }) => { sqlx::query!("INSERT INTO json_user_data (id, value) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING", i64::from(id), value).execute(&db_pool).await?; }
+        Request::EventIds { upcoming, attendee } => Json::Array(
+            sqlx::query_scalar::<_, String>("SELECT id FROM events_index WHERE ($1::bool IS NULL OR (end_time IS NULL OR end_time > NOW()) = $1) AND ($2::int8 IS NULL OR signups @> ARRAY[$2::int8]) ORDER BY start_time ASC NULLS LAST, end_time ASC NULLS LAST, id COLLATE \"C\" ASC")
+                .bind(upcoming)
+                .bind(attendee.map(|id| id.parse::<i64>()).transpose()?)
+                .fetch_all(db_pool).await?
+                .into_iter()
+                .map(Json::String)
+                .collect()
+        ),
+        Request::PatchMany { patches, outbox } => {
+            let mut transaction = db_pool.begin().await?;
+            for Patch { table, id, version, ops } in patches {
+                if let Table::Profiles = table {
+                    // profiles aren't versioned, so they're always written in full
+                    let Ok([PatchOp::Set { path, value }]) = <[_; 1]>::try_from(ops) else { return Err(Error::PatchProfiles) };
+                    if !path.is_empty() { return Err(Error::PatchProfiles) }
+                    upsert_profile(&mut *transaction, &id, value).await?;
+                    continue
+                }
+                check_version(&mut transaction, table, &id, version).await?;
+                for op in ops {
+                    apply_patch_op(&mut transaction, table, &id, op).await?;
+                }
+            }
+            for command in outbox {
+                sqlx::query("INSERT INTO discord_outbox (command) VALUES ($1)").bind(sqlx::types::Json(command)).execute(&mut *transaction).await?;
+            }
+            transaction.commit().await?;
+            Json::Null
+        }
+    }))
+}
+
+fn versioned(value: Json, version: i64) -> Json {
+    serde_json::json!({
+        "value": value,
+        "version": version,
+    })
+}
+
+fn response(result: Result<Option<Json>, Error>) -> Response {
+    match result {
+        Ok(Some(value)) => Response::Ok(value),
+        Ok(None) => Response::NotFound,
+        Err(Error::Conflict) => Response::Conflict,
+        Err(Error::UniqueViolation) => Response::UniqueViolation,
+        Err(e) => Response::Error(e.to_string()),
+    }
+}
+
+async fn serve_connection(db_pool: &PgPool, stream: UnixStream) -> Result<(), Error> {
+    let (reader, mut writer) = stream.into_split();
+    let mut lines = BufReader::new(reader).lines();
+    // requests are answered in order, so clients can pipeline them
+    while let Some(line) = lines.next_line().await? {
+        let response = match serde_json::from_str::<Request>(&line) {
+            Ok(request) => response(handle(db_pool, request).await),
+            Err(e) => Response::Error(e.to_string()),
+        };
+        let mut buf = serde_json::to_vec(&response)?;
+        buf.push(b'\n');
+        writer.write_all(&buf).await?;
+    }
+    Ok(())
+}
+
+async fn daemon(db_pool: PgPool, socket: PathBuf) -> Result<i32, Error> {
+    match fs::remove_file(&socket).await {
+        Ok(()) => {}
+        Err(e) if e.kind() == io::ErrorKind::NotFound => {}
+        Err(e) => return Err(e.into()),
+    }
+    let listener = UnixListener::bind(&socket)?;
+    loop {
+        let (stream, _) = listener.accept().await?;
+        let db_pool = db_pool.clone();
+        tokio::spawn(async move {
+            if let Err(e) = serve_connection(&db_pool, stream).await {
+                eprintln!("error in gefolge-web-back daemon connection: {e}");
+            }
+        });
+    }
+}
+
+#[wheel::main(debug)]
+async fn main(args: Args) -> Result<i32, Error> {
+    let db_pool = PgPool::connect_with(PgConnectOptions::default().username("fenhl").database("gefolge").application_name("gefolge-web-back")).await?;
+    let request = match args {
+        Args::Daemon { socket } => return daemon(db_pool, socket).await,
+        Args::Request => {
+            let request = serde_json::from_reader(stdin())?;
+            serde_json::to_writer(stdout(), &response(handle(&db_pool, request).await))?;
+            return Ok(0)
+        }
+        Args::Events(subcommand) => subcommand.into_request(Table::Events),
+        Args::Locations(subcommand) => subcommand.into_request(Table::Locations),
+        Args::Profiles(subcommand) => subcommand.into_request(Table::Profiles),
+        Args::UserData(subcommand) => subcommand.into_request(Table::UserData),
+        Args::UserIdByApiKey { api_key } => Request::UserIdByApiKey { api_key },
+        Args::EventIds { upcoming, past, attendee } => Request::EventIds { upcoming: if upcoming { Some(true) } else if past { Some(false) } else { None }, attendee },
+    };
+    let is_get = matches!(request, Request::Get { .. } | Request::GetMany { .. } | Request::UserIdByApiKey { .. });
+    let is_list = matches!(request, Request::List { .. } | Request::EventIds { .. });
+    let Some(value) = handle(&db_pool, request).await? else { return Ok(2) };
+    if is_list {
+        for id in value.as_array().into_iter().flatten() {
+            println!("{}", id.as_str().unwrap_or_default());
+        }
+    } else if is_get {
+        serde_json::to_writer(stdout(), &value)?;
     }
     Ok(0)
 }
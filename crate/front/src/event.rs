@@ -104,14 +104,15 @@ pub(crate) struct EventsOverview {
     pub(crate) upcoming: Vec<EventOverview>,
 }
 
-pub(crate) async fn load_events(transaction: &mut Transaction<'_, Postgres>) -> Result<EventsOverview, IndexError> {
+/// Past events are only loaded if `include_past` is true. The end times are taken from `events_index` (see assets/events-index.sql), so other events aren't loaded at all.
+pub(crate) async fn load_events(transaction: &mut Transaction<'_, Postgres>, include_past: bool) -> Result<EventsOverview, IndexError> {
     let now = Utc::now();
     let mut past = Vec::default();
     let mut upcoming = Vec::default();
-    for row in sqlx::query!(r#"SELECT id AS "id: Id", value AS "value: Json<Event>" FROM json_events"#).fetch_all(&mut **transaction).await.at("load_events")? {
-        let start = row.value.0.start(&mut *transaction).await?;
-        let end = row.value.0.end(&mut *transaction).await?;
-        if end.is_none_or(|end| end > now) { &mut upcoming } else { &mut past }.push(EventOverview { id: row.id, start, end, event: row.value.0 });
+    for (id, Json(event)) in sqlx::query_as::<_, (Id, Json<Event>)>("SELECT json_events.id, json_events.value FROM events_index JOIN json_events USING (id) WHERE $1 OR events_index.end_time IS NULL OR events_index.end_time > $2").bind(include_past).bind(now).fetch_all(&mut **transaction).await.at("load_events")? {
+        let start = event.start(&mut *transaction).await?;
+        let end = event.end(&mut *transaction).await?;
+        if end.is_none_or(|end| end > now) { &mut upcoming } else { &mut past }.push(EventOverview { id, start, end, event });
     }
     upcoming.sort_unstable_by(|EventOverview { id: id1, start: start1, .. }, EventOverview { id: id2, start: start2, ..}|
         start1.is_none().cmp(&start2.is_none()) // nulls last
@@ -130,7 +131,7 @@ pub(crate) async fn load_events(transaction: &mut Transaction<'_, Postgres>) ->
 #[rocket::get("/event")]
 pub(crate) async fn index(db_pool: &State<PgPool>, me: Mensch, uri: Origin<'_>) -> Result<RawHtml<String>, IndexError> {
     let mut transaction = db_pool.begin().await.at("begin (/event)")?;
-    let events = load_events(&mut transaction).await?;
+    let events = load_events(&mut transaction, true).await?;
     let content = html! {
         @let viewer_data = me.data(&mut transaction).await.at("viewer_data (/event)")?;
         h1 : "Events";
@@ -348,7 +348,7 @@ impl<T> SqlResultExt<T> for sqlx::Result<T> {
 async fn index(db_pool: &State<PgPool>, me: Option<DiscordUser>, uri: Origin<'_>) -> Result<RawHtml<String>, IndexError> {
     Ok(if let Some(DiscordUser { id }) = me {
         let mut transaction = db_pool.begin().await.at("begin 1")?;
-        let events = load_events(&mut transaction).await?;
+        let events = load_events(&mut transaction, false).await?;
         let content = html! {
             @let user = User::from_id(&mut transaction, id).await.at("User::from_id")?;
             @let is_mensch_or_guest = user.as_ref().is_some_and(|user| user.is_mensch() || user.is_guest());
@@ -190,14 +190,15 @@ async fn client_session_v2(db_pool: PgPool, mut rocket_shutdown: rocket::Shutdow
                                 let mut transaction = db_pool.begin().await?;
                                 let now = Utc::now();
                                 let mut current_event = None;
-                                for row in sqlx::query!(r#"SELECT id, value AS "value: Json<Event>" FROM json_events"#).fetch_all(&mut *transaction).await? {
-                                    if let (Some(start), Some(end)) = (row.value.start(&mut transaction).await?, row.value.end(&mut transaction).await?) {
+                                // only load the events that are ongoing according to events_index, see assets/events-index.sql
+                                for (id, Json(event)) in sqlx::query_as::<_, (String, Json<Event>)>("SELECT json_events.id, json_events.value FROM events_index JOIN json_events USING (id) WHERE events_index.start_time <= $1 AND events_index.end_time > $1").bind(now).fetch_all(&mut *transaction).await? {
+                                    if let (Some(start), Some(end)) = (event.start(&mut transaction).await?, event.end(&mut transaction).await?) {
                                         if start <= now && now < end {
                                             if let Some(other) = current_event.replace(EventData {
-                                                id: row.id.clone(),
-                                                timezone: row.value.timezone(&mut transaction).await?.unwrap_or(Europe::Berlin),
+                                                id: id.clone(),
+                                                timezone: event.timezone(&mut transaction).await?.unwrap_or(Europe::Berlin),
                                             }) {
-                                                return Err(Error::MultipleCurrentEvents([row.id, other.id]).into())
+                                                return Err(Error::MultipleCurrentEvents([id, other.id]).into())
                                             }
                                         }
                                     }
@@ -44,9 +44,11 @@ except ImportError as e:
     werewolf_web = None
 
 import gefolge_web.api
+import gefolge_web.db
 import gefolge_web.event
 import gefolge_web.games
 import gefolge_web.login
+import gefolge_web.outbox
 import gefolge_web.util
 
 DOCUMENT_ROOT = os.environ.get('FLASK_ROOT_PATH', '/opt/git/github.com/dasgefolge/gefolge.org/main')
@@ -65,6 +67,8 @@ with app.app_context():
         app.config.update(gefolge_web.util.cached_json(lazyjson.File(gefolge_web.util.CONFIG_PATH)).value())
     # set up database
     db = flask_sqlalchemy.SQLAlchemy(app)
+    gefolge_web.db.setup(app)
+    gefolge_web.outbox.setup(app)
     # set up API clients
     if 'challonge' in app.config:
         challonge.set_credentials(app.config['challonge']['username'], app.config['challonge']['apiKey'])
@@ -1,30 +1,98 @@
+import datetime
 import functools
+import hashlib
 
 import flask # PyPI: Flask
 import icalendar # PyPI: icalendar
 import simplejson # PyPI: simplejson
 
+import gefolge_web.db
 import gefolge_web.event.model
 import gefolge_web.event.programm
 import gefolge_web.login
+import gefolge_web.outbox
 import gefolge_web.person
 import gefolge_web.util
 
 DISCORD_VOICE_STATE_PATH = gefolge_web.util.BASE_PATH / 'discord' / 'voice-state.json'
+ICAL_FEEDS = {} # snowflake → (table versions, response body, ETag, Last-Modified) of the user's signups.ics
+ICAL_FRAGMENTS = {} # event ID → (key, fragments), see ical_fragments
 
-def json_child(node, name, *args, **kwargs):
+def ical_calendar(name):
+    cal = icalendar.Calendar()
+    cal.add('prodid', '-//Gefolge//gefolge.org//DE')
+    cal.add('version', '2.0')
+    cal.add('x-wr-calname', name)
+    return cal
+
+def ical_fragments(event):
+    """Returns the serialized VEVENTs for the given event and its calendar as a list of (audience, fragment) pairs. The audience is the set of snowflakes of the people whose signups.ics includes the fragment.
+
+    The fragments are cached until the event data or its location's address or timezone changes.
+    """
+    key = event.digest, None if event.location is None else event.location.address, str(event.timezone)
+    cached = ICAL_FRAGMENTS.get(event.event_id)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    signups = {person.snowflake for person in event.signups}
+    fragments = [(signups, event.to_ical().to_ical())]
+    for calendar_event in event.calendar:
+        if calendar_event.programmpunkt is None or isinstance(calendar_event.programmpunkt, gefolge_web.event.model.Event):
+            audience = signups
+        else:
+            audience = {person.snowflake for person in calendar_event.programmpunkt.signups}
+            if calendar_event.programmpunkt.orga is not None:
+                audience.add(calendar_event.programmpunkt.orga.snowflake)
+        fragments.append((audience, calendar_event.to_ical().to_ical()))
+    ICAL_FRAGMENTS[event.event_id] = key, fragments
+    return fragments
+
+def json_child(node, name, *args, versions=None, **kwargs):
+    """Adds a JSON endpoint to the view tree. Clients can request compact JSON using the `compact` query parameter.
+
+    `versions` may be a function which takes the same arguments as the view function and returns a JSON-serializable value that changes whenever the response might change, e.g. a list of row versions, or `None` if this can't be determined. If given, the response gets a strong ETag, and requests with a matching If-None-Match header are answered with 304 Not Modified without calling the view function.
+    """
     def decorator(f):
         @node.child(name + '.json', *args, **kwargs)
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            result = simplejson.dumps(f(*args, **kwargs), use_decimal=True, sort_keys=True, indent=4)
-            return flask.Response(result, mimetype='application/json')
+            compact = 'compact' in flask.request.args
+            etag = None
+            if versions is not None:
+                current_versions = versions(*args, **kwargs)
+                if current_versions is not None:
+                    # the response also depends on who's asking and on the format
+                    etag = hashlib.sha256(simplejson.dumps([name, flask.g.user.snowflake, compact, current_versions], sort_keys=True).encode('utf-8')).hexdigest()
+                    if etag in flask.request.if_none_match:
+                        response = flask.Response(status=304)
+                        response.set_etag(etag)
+                        return response
+            if compact:
+                result = simplejson.dumps(f(*args, **kwargs), use_decimal=True, sort_keys=True, separators=(',', ':'))
+            else:
+                result = simplejson.dumps(f(*args, **kwargs), use_decimal=True, sort_keys=True, indent=4)
+            response = flask.Response(result, mimetype='application/json')
+            if etag is not None:
+                response.set_etag(etag)
+            return response
 
         wrapper.raw = f
         return wrapper
 
     return decorator
 
+def overview_profile_ids(value):
+    """Returns the snowflakes of the people whose profiles are used in the overview of the event with the given data."""
+    ids = {person['id'] for person in value.get('menschen', [])}
+    ids.update(programmpunkt['orga'] for programmpunkt in value.get('programm', {}).values() if programmpunkt.get('orga') is not None)
+    ids.update(essen['orga'] for essen in value.get('essen', {}).values() if essen.get('orga') is not None)
+    return sorted(int(snowflake) for snowflake in ids if int(snowflake) >= 100) # smaller IDs are guests
+
+def row_version(file):
+    """Returns the version of a row loaded through `gefolge_web.util.cached_json`, or `None` if it's unknown or the row has been modified during this request."""
+    if isinstance(file, gefolge_web.db.BatchedFile):
+        return file.version()
+
 def setup(index):
     @index.child('api', 'API', decorators=[gefolge_web.login.mensch_required]) #TODO review endpoints that should be available to guests
     def api_index():
@@ -39,17 +107,33 @@ def setup(index):
     @api_calendars_index.child('signups.ics')
     def calendar_signups():
         """Ein Kalender im iCalendar-Format mit allen events und Programmpunkten, für die du angemeldet bist."""
-        cal = icalendar.Calendar()
-        cal.add('prodid', '-//Gefolge//gefolge.org//DE')
-        cal.add('version', '2.0')
-        cal.add('x-wr-calname', 'gefolge.org')
-        for event in gefolge_web.event.model.Event:
-            if event.start is not None and flask.g.user in event.signups:
-                cal.add_component(event.to_ical())
-                for calendar_event in event.calendar:
-                    if calendar_event.programmpunkt is None or calendar_event.programmpunkt.orga == flask.g.user or flask.g.user in calendar_event.programmpunkt.signups:
-                        cal.add_component(calendar_event.to_ical())
-        return flask.Response(cal.to_ical(), mimetype='text/calendar')
+        # if no event or location has changed since the feed was last generated, it can be served (or confirmed unchanged) without touching the database
+        cache = gefolge_web.db.SHARED_CACHE
+        versions = None if cache is None else (cache.table_version('events'), cache.table_version('locations'))
+        if versions is not None and None in versions:
+            versions = None
+        cached = ICAL_FEEDS.get(flask.g.user.snowflake)
+        if versions is not None and cached is not None and cached[0] == versions:
+            _, body, etag, last_modified = cached
+        else:
+            header, footer = ical_calendar('gefolge.org').to_ical().rsplit(b'END:VCALENDAR', 1)
+            body = header + b''.join(
+                fragment
+                for event in gefolge_web.event.model.Event.attended_by(flask.g.user)
+                if event.start is not None
+                for audience, fragment in ical_fragments(event)
+                if flask.g.user.snowflake in audience
+            ) + b'END:VCALENDAR' + footer
+            etag = hashlib.sha256(body).hexdigest()
+            if cached is not None and cached[2] == etag:
+                last_modified = cached[3]
+            else:
+                last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+            ICAL_FEEDS[flask.g.user.snowflake] = versions, body, etag, last_modified
+        response = flask.Response(body, mimetype='text/calendar')
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response.make_conditional(flask.request)
 
     @api_index.child('discord')
     @gefolge_web.util.template('api-dir')
@@ -85,15 +169,30 @@ def setup(index):
     @event_calendars.child('all.ics')
     def event_calendar_all(event):
         """Ein Kalender im iCalendar-Format mit allen Programmpunkten von diesem event."""
-        cal = icalendar.Calendar()
-        cal.add('prodid', '-//Gefolge//gefolge.org//DE')
-        cal.add('version', '2.0')
-        cal.add('x-wr-calname', str(event))
+        cal = ical_calendar(str(event))
         for calendar_event in event.calendar:
             cal.add_component(calendar_event.to_ical())
         return flask.Response(cal.to_ical(), mimetype='text/calendar')
 
-    @json_child(api_event, 'overview')
+    def api_event_overview_versions(event):
+        # roles and names of people, e.g. in info-beamer subtitles, are taken from their profiles, which don't have versions, so a digest is used instead
+        profiles = gefolge_web.login.all_profiles()
+        result = [
+            row_version(event.data),
+            # the requesting user's roles determine what they can edit
+            hashlib.sha256(simplejson.dumps([profiles.get(snowflake) for snowflake in [*event.data.memoize('overviewProfileIds', overview_profile_ids), flask.g.user.snowflake]], sort_keys=True).encode('utf-8')).hexdigest(),
+        ]
+        if event.location is not None and not event.location.is_online:
+            result.append(row_version(event.location.data))
+        # bank details are taken from the user data of the requesting user and the Abrechnung orga
+        result.append(flask.g.user.userdata_version)
+        if event.orga('Abrechnung') is not None:
+            result.append(event.orga('Abrechnung').userdata_version)
+        if None in result:
+            return None
+        return result
+
+    @json_child(api_event, 'overview', versions=api_event_overview_versions)
     def api_event_overview(event):
         """Infos zu diesem event im auf <https://gefolge.org/wiki/event-json/meta> dokumentierten Format."""
 
@@ -168,12 +267,35 @@ def setup(index):
             if event.location.is_online:
                 result['location'] = 'online'
             else:
-                result['location'] = event.location.data.value()
-                result['location']['id'] = event.location.loc_id
+                result['location'] = {**event.location.data.value(), 'id': event.location.loc_id} # don't modify the cached value
         if event.start is not None:
             result['start'] = f'{event.start:%Y-%m-%dT%H:%M:%S}'
         return result
 
+    @json_child(api_index, 'check-balances')
+    def api_check_balances():
+        """Berechnet die zwischengespeicherten Guthaben dieses worker-Prozesses neu und listet die, die falsch waren. Nur für admins."""
+        if not flask.g.user.is_admin:
+            flask.abort(403)
+        return [
+            {
+                'actual': actual.value,
+                'cached': cached.value,
+                'mensch': mensch.snowflake,
+            }
+            for mensch, cached, actual in gefolge_web.login.Mensch.check_balances()
+        ]
+
+    @json_child(api_index, 'stats')
+    def api_stats():
+        """Statistiken über die Schreibzugriffe auf die Datenbank und die Discord-Nachrichten in der Warteschlange seit dem Start dieses worker-Prozesses. Nur für admins."""
+        if not flask.g.user.is_admin:
+            flask.abort(403)
+        return {
+            'outbox': gefolge_web.outbox.stats(),
+            'writes': dict(gefolge_web.db.WRITE_STATS),
+        }
+
     @api_index.child('websocket')
     def api_websocket():
         """Ein WebSocket server für länger dauernde Verbindungen. Dokumentation siehe <https://github.com/dasgefolge/gefolge-websocket>"""
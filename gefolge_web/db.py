@@ -1,20 +1,538 @@
+import collections
+import contextlib
+import copy
+import datetime
+import functools
+import itertools
+import os
+import select
+import socket
 import subprocess
+import threading
+import time
 
+import more_itertools # PyPI: more-itertools
 import simplejson # PyPI: simplejson
 
+try:
+    import psycopg2.errors # PyPI: psycopg2
+    import psycopg2.extras # PyPI: psycopg2
+    import psycopg2.pool # PyPI: psycopg2
+except ImportError:
+    psycopg2 = None
+
 import lazyjson # https://github.com/fenhl/lazyjson
 
+BACK_PATH = '/home/fenhl/bin/gefolge-web-back'
+DAEMON_SOCKET_PATH = '/run/gefolge-web-back/socket'
+FLUSH_ATTEMPTS = 5
+NOTIFY_CHANNEL = 'gefolge_web_rows' # see assets/json-notify.sql
 NO_INIT = object()
+PROFILE_VERSION = 0 # the users table has no version column, so profiles are never written with a version check
+
+ID_TYPES = {
+    'events': str,
+    'locations': str,
+    'profiles': int,
+    'user-data': int,
+}
+# maps table names as used by gefolge-web-back to the Postgres table storing the JSON documents
+JSON_TABLES = {
+    'events': 'json_events',
+    'locations': 'json_locations',
+    'user-data': 'json_user_data',
+}
+
+class BackendError(Exception):
+    pass
+
+class Conflict(BackendError):
+    """Raised by `patch_many` if a row was modified since the version that was patched."""
+
+    def __init__(self):
+        super().__init__('a row was modified concurrently')
+
+class UniqueViolation(Conflict):
+    """Raised by `patch_many` if a patch would violate a unique index, e.g. the one on API keys in assets/json-indexes.sql. Unlike other conflicts, this can't be resolved by rebasing."""
+
+    def __init__(self):
+        BackendError.__init__(self, 'a value that must be unique is already in use')
+
+def not_found(table, id):
+    #HACK: using FileNotFoundError for compatibility with the previous backend
+    return FileNotFoundError(f'No row with ID {id!r} in table {table!r}')
+
+class RequestBackend:
+    """Base class for backends which send requests in the format used by `gefolge-web-back daemon`. Subclasses implement `request`."""
+
+    def get(self, table, id):
+        row = unwrap_response(table, id, self.request({'cmd': 'get-versioned', 'table': table, 'id': str(id)}))
+        return row['value'], row['version']
+
+    def event_ids(self, *, upcoming=None, attendee=None):
+        return unwrap_response('events', None, self.request({'cmd': 'event-ids', 'upcoming': upcoming, 'attendee': None if attendee is None else str(attendee)}))
+
+    def get_many(self, table, ids=None):
+        rows = unwrap_response(table, None, self.request({'cmd': 'get-many-versioned', 'table': table, 'ids': None if ids is None else [str(id) for id in ids]}))
+        return {
+            id: (row['value'], row['version'])
+            for id, row in rows.items()
+        }
+
+    def list(self, table):
+        return unwrap_response(table, None, self.request({'cmd': 'list', 'table': table}))
+
+    def patch_many(self, patches, outbox=()):
+        unwrap_response(None, None, self.request({'cmd': 'patch-many', 'patches': [{'table': table, 'id': str(id), 'version': version, 'ops': ops} for table, id, version, ops in patches], 'outbox': list(outbox)}))
+
+    def set(self, table, id, value):
+        unwrap_response(table, id, self.request({'cmd': 'set', 'table': table, 'id': str(id), 'value': value}))
+
+    def set_if_not_exists(self, table, id, value):
+        unwrap_response(table, id, self.request({'cmd': 'set-if-not-exists', 'table': table, 'id': str(id), 'value': value}))
+
+    def user_id_by_api_key(self, api_key):
+        try:
+            return int(unwrap_response('user-data', None, self.request({'cmd': 'user-id-by-api-key', 'api_key': api_key})))
+        except FileNotFoundError:
+            return None
+
+class SubprocessBackend(RequestBackend):
+    """Runs a new gefolge-web-back process for each query. Slow, but doesn't require a Postgres driver in the Python process."""
+
+    def __repr__(self):
+        return 'gefolge_web.db.SubprocessBackend()'
+
+    def request(self, command):
+        return simplejson.loads(subprocess.run([BACK_PATH, 'request'], input=simplejson.dumps(command, use_decimal=True), stdout=subprocess.PIPE, encoding='utf-8', check=True).stdout, use_decimal=True)
+
+class PoolBackend:
+    """Talks to Postgres directly, using a pool of connections that stays open for the lifetime of the worker process."""
+
+    def __init__(self, dsn, *, maxconn=8):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pool = None
+
+    def __repr__(self):
+        return f'gefolge_web.db.PoolBackend({self.dsn!r}, maxconn={self.maxconn!r})'
+
+    def connection(self):
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                # uWSGI forks workers after loading the app, so each worker needs to open its own connections
+                self.pool = psycopg2.pool.ThreadedConnectionPool(1, self.maxconn, self.dsn, application_name='gefolge-web')
+                self.pid = os.getpid()
+            pool = self.pool
+        conn = pool.getconn()
+        psycopg2.extras.register_default_jsonb(conn, loads=functools.partial(simplejson.loads, use_decimal=True))
+        return pool, conn
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Returns a cursor for a transaction which is committed when the `with` block exits normally and rolled back otherwise."""
+        pool, conn = self.connection()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    yield cur
+        finally:
+            # don't hand out connections that were broken, e.g. by a database restart
+            pool.putconn(conn, close=bool(conn.closed))
+
+    def execute(self, query, params=(), *, fetch=None):
+        with self.cursor() as cur:
+            cur.execute(query, params)
+            if fetch == 'one':
+                return cur.fetchone()
+            elif fetch == 'all':
+                return cur.fetchall()
+
+    def get(self, table, id):
+        if table == 'profiles':
+            row = self.execute('SELECT discriminator, joined, nick, roles, username FROM users WHERE snowflake = %s', (int(id),), fetch='one')
+            if row is None:
+                raise not_found(table, id)
+            return profile_json(int(id), *row), PROFILE_VERSION
+        row = self.execute(f'SELECT value, version FROM {JSON_TABLES[table]} WHERE id = %s', (ID_TYPES[table](id),), fetch='one')
+        if row is None:
+            raise not_found(table, id)
+        return tuple(row)
+
+    def event_ids(self, *, upcoming=None, attendee=None):
+        if attendee is not None:
+            attendee = int(attendee)
+        rows = self.execute('''
+            SELECT id FROM events_index
+            WHERE (%s::bool IS NULL OR (end_time IS NULL OR end_time > NOW()) = %s)
+            AND (%s::int8 IS NULL OR signups @> ARRAY[%s::int8])
+            ORDER BY start_time ASC NULLS LAST, end_time ASC NULLS LAST, id COLLATE "C" ASC
+        ''', (upcoming, upcoming, attendee, attendee), fetch='all')
+        return [id for id, in rows]
+
+    def get_many(self, table, ids=None):
+        if ids is not None:
+            ids = [ID_TYPES[table](id) for id in ids]
+        if table == 'profiles':
+            rows = self.execute('SELECT snowflake, discriminator, joined, nick, roles, username FROM users WHERE %s::int8[] IS NULL OR snowflake = ANY(%s::int8[])', (ids, ids), fetch='all')
+            return {str(row[0]): (profile_json(*row), PROFILE_VERSION) for row in rows}
+        id_type = 'text' if ID_TYPES[table] is str else 'int8'
+        rows = self.execute(f'SELECT id, value, version FROM {JSON_TABLES[table]} WHERE %s::{id_type}[] IS NULL OR id = ANY(%s::{id_type}[])', (ids, ids), fetch='all')
+        return {str(id): (value, version) for id, value, version in rows}
+
+    def list(self, table):
+        if table == 'profiles':
+            rows = self.execute('SELECT snowflake FROM users', fetch='all')
+        else:
+            rows = self.execute(f'SELECT id FROM {JSON_TABLES[table]}', fetch='all')
+        return [str(id) for id, in rows]
+
+    def patch_many(self, patches, outbox=()):
+        with self.cursor() as cur:
+            for table, id, version, ops in patches:
+                if table not in JSON_TABLES:
+                    # profiles aren't versioned, so they're always written in full
+                    if len(ops) != 1 or ops[0]['op'] != 'set' or len(ops[0]['path']) != 0:
+                        raise ValueError(f'The {table} table can only be written in full')
+                    self.upsert_statement(cur, table, id, ops[0]['value'], on_conflict='update')
+                    continue
+                id = ID_TYPES[table](id)
+                if version is None:
+                    # claim the ID, so concurrent attempts to create the same row conflict
+                    cur.execute(f"INSERT INTO {JSON_TABLES[table]} (id, value) VALUES (%s, '{{}}') ON CONFLICT (id) DO NOTHING", (id,))
+                    if cur.rowcount == 0:
+                        raise Conflict()
+                else:
+                    cur.execute(f'SELECT version FROM {JSON_TABLES[table]} WHERE id = %s FOR UPDATE', (id,))
+                    row = cur.fetchone()
+                    if row is None or row[0] != version:
+                        raise Conflict()
+                self.patch_statements(cur, table, id, ops)
+            for command in outbox:
+                cur.execute('INSERT INTO discord_outbox (command) VALUES (%s)', (pg_json(command),))
+
+    def patch_statements(self, cur, table, id, ops):
+        # all statements for a row are sent in a single round trip
+        statements = []
+        params = []
+        for op in ops:
+            if op['op'] == 'set' and len(op['path']) == 0:
+                statements.append(f'INSERT INTO {JSON_TABLES[table]} (id, value) VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET value = EXCLUDED.value')
+                params += [id, pg_json(op['value'])]
+            elif op['op'] == 'set':
+                statements.append(f'UPDATE {JSON_TABLES[table]} SET value = JSONB_SET(value, %s, %s) WHERE id = %s')
+                params += [op['path'], pg_json(op['value']), id]
+            elif op['op'] == 'delete':
+                statements.append(f'UPDATE {JSON_TABLES[table]} SET value = value #- %s WHERE id = %s')
+                params += [op['path'], id]
+            elif op['op'] == 'append':
+                statements.append(f"UPDATE {JSON_TABLES[table]} SET value = JSONB_SET(value, %s, COALESCE(value #> %s, '[]') || %s) WHERE id = %s")
+                params += [op['path'], op['path'], pg_json(op['values']), id]
+            else:
+                raise ValueError(f'Unknown patch operation: {op["op"]!r}')
+        if statements:
+            try:
+                cur.execute(';\n'.join(statements), params)
+            except psycopg2.errors.UniqueViolation as e:
+                raise UniqueViolation() from e
+
+    def set(self, table, id, value):
+        self.upsert(table, id, value, on_conflict='update')
+
+    def set_if_not_exists(self, table, id, value):
+        self.upsert(table, id, value, on_conflict='nothing')
+
+    def user_id_by_api_key(self, api_key):
+        row = self.execute("SELECT id FROM json_user_data WHERE value -> 'apiKey' = %s", (pg_json(api_key),), fetch='one')
+        if row is not None:
+            return row[0]
+
+    def upsert(self, table, id, value, *, on_conflict):
+        with self.cursor() as cur:
+            self.upsert_statement(cur, table, id, value, on_conflict=on_conflict)
+
+    def upsert_statement(self, cur, table, id, value, *, on_conflict):
+        if table == 'profiles':
+            cur.execute(f"""
+                INSERT INTO users
+                (snowflake, discriminator, joined, nick, roles, username)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (snowflake) DO {'''UPDATE SET
+                discriminator = EXCLUDED.discriminator,
+                joined = EXCLUDED.joined,
+                nick = EXCLUDED.nick,
+                roles = EXCLUDED.roles,
+                username = EXCLUDED.username''' if on_conflict == 'update' else 'NOTHING'}
+            """, (
+                int(id),
+                None if value.get('discriminator') is None else int(value['discriminator']),
+                value.get('joined'),
+                value.get('nick'),
+                pg_json(value.get('roles', [])),
+                value['username'],
+            ))
+        else:
+            cur.execute(f"INSERT INTO {JSON_TABLES[table]} (id, value) VALUES (%s, %s) ON CONFLICT (id) DO {'UPDATE SET value = EXCLUDED.value' if on_conflict == 'update' else 'NOTHING'}", (ID_TYPES[table](id), pg_json(value)))
+
+class DaemonBackend(RequestBackend):
+    """Talks to a long-running `gefolge-web-back daemon` process over a Unix socket, using one JSON value per line in each direction."""
+
+    def __init__(self, path=DAEMON_SOCKET_PATH):
+        self.path = path
+        self.local = threading.local()
+
+    def __repr__(self):
+        return f'gefolge_web.db.DaemonBackend({self.path!r})'
+
+    def connection(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            # don't share connections with the uWSGI master or other workers
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self.local.conn = sock.makefile('rwb')
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def pipeline(self, commands):
+        """Sends all of the given commands before reading any responses, so they only take a single round trip."""
+        conn = self.connection()
+        try:
+            for command in commands:
+                conn.write(simplejson.dumps(command, use_decimal=True).encode('utf-8') + b'\n')
+            conn.flush()
+            responses = []
+            for _ in commands:
+                line = conn.readline()
+                if not line:
+                    raise ConnectionError('gefolge-web-back daemon closed the connection')
+                responses.append(simplejson.loads(line, use_decimal=True))
+        except (OSError, ValueError):
+            # the connection is in an unknown state, reconnect on next use
+            self.local.pid = None
+            conn.close()
+            raise
+        return responses
+
+    def request(self, command):
+        return more_itertools.one(self.pipeline([command]))
+
+def json_patch(old, new, path=()):
+    """Returns a list of operations which turn `old` into `new` when applied by `patch_many`, touching only the parts of the document that differ."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [
+            {'op': 'delete', 'path': [*path, key]}
+            for key in old
+            if key not in new
+        ]
+        for key, value in new.items():
+            if key in old:
+                ops += json_patch(old[key], value, (*path, key))
+            else:
+                ops.append({'op': 'set', 'path': [*path, key], 'value': value})
+        return ops
+    elif isinstance(old, list) and isinstance(new, list):
+        if len(new) > len(old) and new[:len(old)] == old:
+            return [{'op': 'append', 'path': list(path), 'values': new[len(old):]}]
+        elif len(new) == len(old):
+            return [
+                op
+                for i, (old_item, new_item) in enumerate(zip(old, new))
+                for op in json_patch(old_item, new_item, (*path, str(i)))
+            ]
+        # other changes to the length of a list are replaced as a whole
+    elif type(old) is type(new) and old == new:
+        return []
+    return [{'op': 'set', 'path': list(path), 'value': new}]
+
+def pg_json(value):
+    return psycopg2.extras.Json(value, dumps=functools.partial(simplejson.dumps, use_decimal=True))
+
+def apply_json_patch(value, ops):
+    """Applies operations as returned by `json_patch` to a value, which is modified in place if possible. Returns the new value."""
+    for op in ops:
+        if op['op'] == 'set' and len(op['path']) == 0:
+            value = op['value']
+            continue
+        parent = value
+        for key in op['path'][:-1]:
+            parent = parent[int(key) if isinstance(parent, list) else key]
+        key = op['path'][-1]
+        if isinstance(parent, list):
+            key = int(key)
+        if op['op'] == 'set':
+            parent[key] = op['value']
+        elif op['op'] == 'delete':
+            del parent[key]
+        elif op['op'] == 'append':
+            parent[key].extend(op['values'])
+        else:
+            raise ValueError(f'Unknown patch operation: {op["op"]!r}')
+    return value
+
+def ops_conflict(a, b):
+    """Checks whether two operations returned by `json_patch` for different modifications of the same value affect the same part of the value."""
+    if a == b:
+        return False
+    shorter, longer = sorted((a, b), key=lambda op: len(op['path']))
+    if longer['path'][:len(shorter['path'])] != shorter['path']:
+        return False # different parts of the value
+    if shorter['op'] == 'append':
+        # appending doesn't affect the existing items of the list, and appends to the same list can happen in either order
+        return len(longer['path']) == len(shorter['path']) and longer['op'] != 'append'
+    return True
+
+def unwrap_response(table, id, response):
+    """Converts a response from gefolge-web-back in the format used by `daemon` and `request` to a return value or exception."""
+    if response == 'notFound':
+        raise not_found(table, id)
+    elif response == 'conflict':
+        raise Conflict()
+    elif response == 'uniqueViolation':
+        raise UniqueViolation()
+    elif 'error' in response:
+        raise BackendError(response['error'])
+    else:
+        return response['ok']
+
+def profile_json(snowflake, discriminator, joined, nick, roles, username):
+    """Formats a row from the users table the same way as `gefolge-web-back profiles get`."""
+    return {
+        'discriminator': None if discriminator is None else f'{discriminator:04}',
+        'joined': None if joined is None else f'{joined.astimezone(datetime.timezone.utc):%Y-%m-%dT%H:%M:%SZ}',
+        'nick': nick,
+        'roles': sorted({str(role) for role in roles}, key=int),
+        'snowflake': str(snowflake),
+        'username': username,
+    }
+
+class SharedCache:
+    """An LRU cache of rows, keyed by (table, id), shared by all requests handled by a worker process.
+
+    Since the Discord bot and the Rust code write to the same tables, entries aren't expired after a fixed time but invalidated by a background thread listening for the notifications sent by the triggers in assets/json-notify.sql. While that thread isn't connected, the cache isn't used.
+
+    Cached values are shared, so they must not be modified.
+    """
+
+    def __init__(self, dsn, *, maxsize=1024):
+        self.dsn = dsn
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.generation = 0 # incremented on each invalidation, so values loaded before an invalidation aren't cached
+        self.table_generations = collections.Counter() # like generation, but per table
+        self.epoch = 0 # incremented each time the cache is cleared
+        self.listening = False
+        self.pid = None
+
+    def __repr__(self):
+        return f'gefolge_web.db.SharedCache({self.dsn!r}, maxsize={self.maxsize!r})'
+
+    def check_listener(self):
+        # must be called with the lock held
+        if self.pid != os.getpid():
+            # threads don't survive uWSGI forking the workers, so each worker needs to start its own listener
+            self.pid = os.getpid()
+            self.clear()
+            self.listening = False
+            threading.Thread(target=self.listen, daemon=True).start()
+
+    def clear(self):
+        # must be called with the lock held
+        self.entries.clear()
+        self.generation += 1
+        self.epoch += 1
+
+    def listen(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn, application_name='gefolge-web-listen')
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {NOTIFY_CHANNEL}')
+                with self.lock:
+                    # notifications may have been missed while disconnected
+                    self.clear()
+                    self.listening = True
+                while True:
+                    select.select([conn], [], [], 60)
+                    conn.poll()
+                    while conn.notifies:
+                        payload = simplejson.loads(conn.notifies.pop(0).payload)
+                        self.invalidate((payload['table'], ID_TYPES[payload['table']](payload['id'])))
+            except (psycopg2.Error, OSError, ValueError):
+                with self.lock:
+                    self.listening = False
+                    self.clear()
+                if conn is not None:
+                    conn.close()
+                time.sleep(5)
+
+    def get(self, key):
+        """Returns the cached (value, version) of the row with the given (table, id) key. Raises KeyError if it's not cached."""
+        with self.lock:
+            self.check_listener()
+            if not self.listening:
+                raise KeyError(key)
+            value = self.entries[key]
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, row, generation):
+        """Caches a (value, version) pair that was loaded from the database after `self.generation` was read as `generation`."""
+        with self.lock:
+            self.check_listener()
+            if self.listening and generation == self.generation:
+                self.entries[key] = row
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.generation += 1
+            self.table_generations[key[0]] += 1
+
+    def table_version(self, table):
+        """Returns a value that changes whenever a row of the given table may have changed, or `None` if changes currently can't be detected.
+
+        This can be used to cache values derived from the whole table."""
+        with self.lock:
+            self.check_listener()
+            if not self.listening:
+                return None
+            return self.epoch, self.table_generations[table]
+
+BACKEND = SubprocessBackend()
+SHARED_CACHE = None
+# counts of writes made through `Batch` since the worker was started. `collapsed` writes were merged into another write to the same row or didn't change anything.
+WRITE_STATS = collections.Counter()
+
+def setup(app):
+    global BACKEND
+    global SHARED_CACHE
+
+    backend = app.config.get('dbBackend', 'pool')
+    if backend == 'pool':
+        if psycopg2 is not None: # otherwise fall back to the subprocess backend
+            BACKEND = PoolBackend(app.config['SQLALCHEMY_DATABASE_URI'])
+    elif backend == 'daemon':
+        BACKEND = DaemonBackend(app.config.get('dbSocket', DAEMON_SOCKET_PATH))
+    elif backend != 'subprocess':
+        raise ValueError(f'Unknown database backend: {backend!r}')
+    cache_size = app.config.get('dbCacheSize', 1024)
+    if psycopg2 is not None and cache_size > 0:
+        SHARED_CACHE = SharedCache(app.config['SQLALCHEMY_DATABASE_URI'], maxsize=cache_size)
 
 class PgFile(lazyjson.BaseFile):
     def __init__(self, table, id, *, init=NO_INIT):
         super().__init__()
         self.table = table
-        self.id = id
-        if init is not NO_INIT:
-            #TODO debug “expecting ParseComplete but received ReadyForQuery” error when using sqlx from flask
-            #rs.db.set_json_if_not_exists(self.table, self.id, simplejson.dumps(init, use_decimal=True))
-            subprocess.run(['/home/fenhl/bin/gefolge-web-back', self.table, 'set-if-not-exists', str(self.id), simplejson.dumps(init, use_decimal=True)], check=True)
+        self.id = ID_TYPES[table](id) # normalize so cache keys match regardless of whether the ID was passed as a string
+        self.init = init # returned by value() if the row doesn't exist yet, the row is created on the first write
 
     def __eq__(self, other):
         return self.table == other.table and self.id == other.id
@@ -25,19 +543,238 @@ class PgFile(lazyjson.BaseFile):
     def __repr__(self):
         return f'gefolge_web.db.PgFile({self.table!r}, {self.id!r})'
 
+    @staticmethod
+    def get_many(table, ids=None):
+        """Loads the given rows, or all rows of the table if `ids` is `None`, in a single query. Returns a dict mapping the IDs of the rows that exist to their values and versions.
+
+        The values are added to the shared cache, so they must not be modified."""
+        if ids is not None:
+            ids = list(ids)
+            if len(ids) == 0:
+                return {}
+        cache = SHARED_CACHE
+        if cache is not None:
+            generation = cache.generation
+        rows = {
+            ID_TYPES[table](id): (value, version)
+            for id, (value, version) in BACKEND.get_many(table, ids).items()
+        }
+        if cache is not None:
+            for id, row in rows.items():
+                cache.put((table, id), row, generation)
+        return rows
+
+    def load(self, *, shared=False):
+        """Returns the value and version of this row. The version is `None` if the row doesn't exist.
+
+        If `shared` is true, the value may be the one held by the shared cache, so it must not be modified."""
+        cache = SHARED_CACHE
+        if cache is not None:
+            try:
+                value, version = cache.get((self.table, self.id))
+            except KeyError:
+                generation = cache.generation
+            else:
+                return (value if shared else copy.deepcopy(value)), version
+        try:
+            value, version = BACKEND.get(self.table, self.id)
+        except FileNotFoundError:
+            if self.init is NO_INIT:
+                raise
+            return copy.deepcopy(self.init), None
+        if cache is not None:
+            cache.put((self.table, self.id), (value, version), generation)
+            if not shared:
+                value = copy.deepcopy(value)
+        return value, version
+
+    def memoize(self, key, compute):
+        """Returns `compute(value)`. Only `BatchedFile` actually reuses the result, this is for compatibility outside of requests."""
+        return compute(self.value())
+
     def set(self, new_value):
-        #TODO debug “expecting ParseComplete but received ReadyForQuery” error when using sqlx from flask
-        #rs.db.set_json(self.table, self.id, simplejson.dumps(new_value, use_decimal=True))
-        subprocess.run(['/home/fenhl/bin/gefolge-web-back', self.table, 'set', str(self.id), simplejson.dumps(new_value, use_decimal=True)], check=True)
+        BACKEND.set(self.table, self.id, new_value)
+        if SHARED_CACHE is not None:
+            # don't wait for the notification so this process doesn't see the old value
+            SHARED_CACHE.invalidate((self.table, self.id))
 
     def value(self):
-        #TODO debug “expecting ParseComplete but received ReadyForQuery” error when using sqlx from flask
-        #return rs.db.get_json(self.table, self.id)
-        try:
-            return simplejson.loads(subprocess.run(['/home/fenhl/bin/gefolge-web-back', self.table, 'get', str(self.id)], stdout=subprocess.PIPE, encoding='utf-8', check=True).stdout, use_decimal=True)
-        except subprocess.CalledProcessError as e:
-            if e.returncode == 2:
-                #HACK: using FileNotFoundError for compatibility with the previous backend
-                raise FileNotFoundError(f'No row with ID {self.id!r} in table {self.table!r}') from e
+        return self.load()[0]
+
+class Batch:
+    """A unit of work for a request. Caches rows and buffers writes to them, so each modified row is written only once, as a JSON patch against its original value, when `flush` is called. All rows are written in a single transaction, together with the Discord commands added to the outbox using `enqueue`.
+
+    Rows are only patched if they haven't been modified since they were loaded. If they have, our patch is rebased onto the new value, unless both modified the same part of the row.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.snapshots = {} # the state of each row in the database when it was loaded, as (value, version), for diffing against
+        self.dirty = {} # rows that have been written to since the last flush, in order of first write. Used as an ordered set.
+        self.writes = 0
+        self.revisions = {} # changes whenever the value of a row is replaced, see memoize
+        self.revision_counter = itertools.count()
+        self.memos = {}
+        self.outbox = [] # Discord commands to be sent by gefolge_web.outbox.Worker once the writes are committed
+
+    def __repr__(self):
+        return 'gefolge_web.db.Batch()'
+
+    def enqueue(self, command):
+        """Adds a Discord command to the outbox. It's written with the next flush and discarded by a rollback, so it's only sent if the request's writes are committed."""
+        self.outbox.append(command)
+
+    def prime(self, file, value, version):
+        """Adds a row that's been loaded elsewhere, e.g. using `PgFile.get_many`, to the cache. The value is not modified. Rows that are already cached, and may have been modified, are left as is."""
+        if file not in self.values:
+            self.store(file, copy.deepcopy(value))
+            self.snapshots[file] = value, version
+
+    def value(self, file):
+        if file not in self.values:
+            value, version = file.load(shared=True)
+            self.store(file, copy.deepcopy(value))
+            self.snapshots[file] = value, version
+        return self.values[file]
+
+    def memoize(self, file, key, compute):
+        """Returns `compute(value)` for the current value of the row, reusing the result until the row is written to or reloaded.
+
+        `key` identifies `compute` among the functions memoized for the same row. Neither `compute` nor the caller may modify the value or the result.
+        """
+        value = self.value(file)
+        revision = self.revisions[file]
+        memo = self.memos.get((file, key))
+        if memo is not None and memo[0] == revision:
+            return memo[1]
+        result = compute(value)
+        self.memos[file, key] = revision, result
+        return result
+
+    def modified(self, table):
+        """Checks whether any rows of the given table have been written to since the last flush."""
+        return any(file.table == table for file in self.dirty)
+
+    def version(self, file):
+        """Returns the version of the row, or `None` if it doesn't exist or has been written to since the last flush."""
+        self.value(file)
+        if file in self.dirty:
+            return None
+        return self.snapshots[file][1]
+
+    def store(self, file, value):
+        self.values[file] = value
+        self.revisions[file] = next(self.revision_counter)
+
+    def set(self, file, new_value):
+        self.value(file) # make sure there's a snapshot to diff against
+        self.store(file, new_value)
+        self.dirty[file] = None
+        self.writes += 1
+
+    def patches(self):
+        for file in self.dirty:
+            old_value, version = self.snapshots[file]
+            if version is None or file.table not in JSON_TABLES:
+                # rows that aren't stored as JSON can't be patched, so they're always written in full
+                yield file, version, [{'op': 'set', 'path': [], 'value': self.values[file]}]
             else:
-                raise
+                ops = json_patch(old_value, self.values[file])
+                if ops:
+                    yield file, version, ops
+
+    def flush(self):
+        for attempt in range(FLUSH_ATTEMPTS):
+            patches = list(self.patches())
+            try:
+                if patches or self.outbox:
+                    BACKEND.patch_many([(file.table, file.id, version, ops) for file, version, ops in patches], self.outbox)
+            except UniqueViolation:
+                raise # rebasing wouldn't change the conflicting value
+            except Conflict:
+                if attempt == FLUSH_ATTEMPTS - 1:
+                    raise
+                WRITE_STATS['conflicts'] += 1
+                self.rebase([file for file, _, _ in patches])
+            else:
+                break
+        rows = len(patches)
+        for file in self.dirty:
+            # the new version isn't known, so reload if needed again
+            del self.values[file]
+            del self.snapshots[file]
+            if SHARED_CACHE is not None:
+                # don't wait for the notification so this process doesn't see the old value
+                SHARED_CACHE.invalidate((file.table, file.id))
+        WRITE_STATS['requested'] += self.writes
+        WRITE_STATS['written'] += rows
+        WRITE_STATS['collapsed'] += self.writes - rows
+        self.dirty = {}
+        self.writes = 0
+        self.outbox = []
+
+    def rebase(self, files):
+        """Reapplies our changes to the given rows on top of their current values. Raises `Conflict` if that's not possible."""
+        tables = collections.defaultdict(list)
+        for file in files:
+            tables[file.table].append(file)
+        for table, files in tables.items():
+            if SHARED_CACHE is not None:
+                for file in files:
+                    SHARED_CACHE.invalidate((table, file.id))
+            current = PgFile.get_many(table, [file.id for file in files])
+            for file in files:
+                old_value, old_version = self.snapshots[file]
+                new_value, new_version = current.get(file.id, (None, None))
+                if new_version == old_version:
+                    continue
+                if old_version is None or new_version is None:
+                    raise Conflict() # created or deleted concurrently
+                ours = json_patch(old_value, self.values[file])
+                theirs = json_patch(old_value, new_value)
+                if any(ops_conflict(our_op, their_op) for our_op in ours for their_op in theirs):
+                    raise Conflict()
+                try:
+                    self.store(file, apply_json_patch(copy.deepcopy(new_value), ours))
+                except (IndexError, KeyError, TypeError, ValueError) as e:
+                    raise Conflict() from e
+                self.snapshots[file] = new_value, new_version
+
+    def rollback(self):
+        """Discards all writes since the last flush."""
+        for file in self.dirty:
+            value, _ = self.snapshots[file]
+            self.store(file, copy.deepcopy(value))
+        WRITE_STATS['rolledBack'] += self.writes
+        self.dirty = {}
+        self.writes = 0
+        self.outbox = []
+
+class BatchedFile(lazyjson.BaseFile):
+    """A view of a `PgFile` whose reads and writes go through a `Batch`."""
+
+    def __init__(self, batch, file):
+        super().__init__()
+        self.batch = batch
+        self.file = file
+
+    def __eq__(self, other):
+        return isinstance(other, BatchedFile) and self.file == other.file
+
+    def __hash__(self):
+        return hash(self.file)
+
+    def __repr__(self):
+        return f'gefolge_web.db.BatchedFile({self.batch!r}, {self.file!r})'
+
+    def set(self, new_value):
+        self.batch.set(self.file, new_value)
+
+    def memoize(self, key, compute):
+        return self.batch.memoize(self.file, key, compute)
+
+    def value(self):
+        return self.batch.value(self.file)
+
+    def version(self):
+        return self.batch.version(self.file)
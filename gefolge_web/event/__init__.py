@@ -1,4 +1,6 @@
+import bisect
 import datetime
+import decimal
 import functools
 import itertools
 import math
@@ -11,12 +13,11 @@ import markupsafe # PyPI: MarkupSafe
 import more_itertools # PyPI: more-itertools
 import pytz # PyPI: pytz
 
-import peter # https://github.com/dasgefolge/peter-discord
-
 import gefolge_web.event.forms
 import gefolge_web.event.model
 import gefolge_web.event.programm
 import gefolge_web.login
+import gefolge_web.outbox
 import gefolge_web.util
 
 def handle_profile_edit(event, person, profile_form):
@@ -92,9 +93,9 @@ def handle_programm_edit(programmpunkt, programm_form, is_new):
         programmpunkt.orga = programm_form.orga.data
         if programmpunkt.orga != old_orga and not is_new:
             if programmpunkt.orga is None:
-                peter.channel_msg(programmpunkt.event.channel, f'{programmpunkt} auf {programmpunkt.event} sucht jetzt eine Orga')
+                gefolge_web.outbox.channel_msg(programmpunkt.event.channel, f'{programmpunkt} auf {programmpunkt.event} sucht jetzt eine Orga')
             else:
-                peter.channel_msg(programmpunkt.event.channel, '{} auf {} wird jetzt von {} organisiert'.format(
+                gefolge_web.outbox.channel_msg(programmpunkt.event.channel, '{} auf {} wird jetzt von {} organisiert'.format(
                     programmpunkt,
                     programmpunkt.event,
                     programmpunkt.orga if programmpunkt.orga.is_guest else f'<@{programmpunkt.orga.snowflake}>'
@@ -105,6 +106,133 @@ def handle_programm_edit(programmpunkt, programm_form, is_new):
         programmpunkt.description = programm_form.description.data
     if hasattr(programm_form, 'css_class'):
         programmpunkt.css_class = programm_form.css_class.data
+    gefolge_web.event.programm.invalidate_timetable(programmpunkt.event)
+
+def programm_table(event):
+    """Returns the cells of the Programm timetable of the given event, as well as the range of hours in the morning which can be omitted from the table."""
+    # events lasting 24 hours or more aren't shown in the table. The calendar is sorted by start time, so the events starting within an hour can be found by bisecting.
+    calendar = [
+        calendar_event
+        for calendar_event in event.calendar
+        if calendar_event.end < calendar_event.start + datetime.timedelta(hours=24)
+    ]
+    calendar_starts = [calendar_event.start for calendar_event in calendar]
+    filled_until = None
+    # rows from hour snip_start to hour snip_end are omitted
+    snip_start = 0
+    snip_end = 24
+
+    def calendar_cell(date, hour):
+        nonlocal filled_until
+        nonlocal snip_start
+        nonlocal snip_end
+
+        timestamp = event.timezone.localize(datetime.datetime.combine(date, datetime.time(hour)), is_dst=None)
+        if filled_until is not None and filled_until > timestamp:
+            return '' # this cell is already filled
+        if timestamp < event.start or timestamp >= event.end:
+            return markupsafe.Markup('<td style="background-color: #666666;"></td>')
+        events_starting_now = calendar[bisect.bisect_left(calendar_starts, timestamp):bisect.bisect_left(calendar_starts, timestamp + datetime.timedelta(hours=1))]
+        if len(events_starting_now) == 0:
+            return markupsafe.Markup('<td></td>') # nothing planned yet
+        elif len(events_starting_now) == 1:
+            calendar_event = more_itertools.one(events_starting_now)
+            hours = math.ceil((min(calendar_event.end, event.timezone.localize(datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time()), is_dst=None)) - timestamp) / datetime.timedelta(hours=1))
+            filled_until = timestamp + datetime.timedelta(hours=hours) #TODO support for events that go past midnight
+            if hour < 6 and hour + hours >= 6:
+                # goes over 06:00, remove snip entirely
+                snip_start = 6
+                snip_end = 6
+            if snip_start < hour + hours < 6:
+                # before 06:00, can only start snip at end hour
+                snip_start = hour + hours
+            if snip_end > hour >= 6:
+                # at or after 06:00, must stop snip at start hour
+                snip_end = hour
+            return markupsafe.Markup('<td rowspan="{}" class="{}">{}{}</td>'.format(hours, calendar_event.css_class, calendar_event.__html__(), '<br />{}'.format(markupsafe.escape(calendar_event.subtitle)) if calendar_event.subtitle else ''))
+        else:
+            #TODO support for events that go past midnight
+            return markupsafe.Markup('<td class="danger">{} Programmpunkte</td>'.format(len(events_starting_now)))
+
+    table = {
+        date: {
+            hour: calendar_cell(date, hour)
+            for hour in range(24)
+        }
+        for date in itertools.chain(event.nights, [event.end.date()])
+    }
+    return table, snip_start, snip_end
+
+def anzahlung_refunds(anzahlung, extra, anzahlungen):
+    """Allocates refunds of Anzahlungen above the regular amount, given the regular Anzahlung, the total amount to refund, and a list of (key, Anzahlung, counted) triples where counted says whether the Anzahlung counts towards the total (i.e. whether that person has completed signup).
+
+    Refunds first go to Anzahlungen which aren't a multiple of the regular Anzahlung but would become one by refunding the entire remaining amount, then to other Anzahlungen which aren't a multiple, then to the rest, largest first. Returns the refunds in order as (key, remaining extra Anzahlung, amount) triples.
+    """
+    zero = decimal.Decimal()
+    regular = anzahlung.value
+    extra = extra.value
+    # work on the Decimal values of a snapshot so the loop doesn't touch the event data
+    remaining = [[key, amount.value, counted] for key, amount, counted in anzahlungen]
+    refunds = []
+    while extra > zero:
+        candidates = [entry for entry in remaining if entry[1] > regular]
+        if len(candidates) == 0:
+            break
+        entry = min(candidates, key=lambda entry: (entry[1] % regular == zero, (entry[1] - extra) % regular != zero, -entry[1]))
+        key, iter_anzahlung, counted = entry
+        if iter_anzahlung % regular == zero or (iter_anzahlung - extra) % regular == zero:
+            amount = min(extra, iter_anzahlung - regular)
+        else:
+            amount = min(extra, iter_anzahlung % regular)
+        entry[1] = iter_anzahlung - amount
+        if counted:
+            extra -= amount
+        refunds.append((key, gefolge_web.util.Euro(iter_anzahlung - amount - regular), gefolge_web.util.Euro(amount)))
+    return refunds
+
+def menschen_table(event):
+    """Computes the table on the Menschen page of the given event in a single pass over the signups. Returns the totals for each night and a row for each person who has completed signup, in order of signup."""
+    rooms = event.rooms
+    nights = []
+    for night in event.nights:
+        statuses, counts = event.night_status(night)
+        free = event.free(night)
+        nights.append({
+            'night': night,
+            'statuses': statuses,
+            'yes': counts['yes'],
+            'maybe': counts['maybe'],
+            # whether people who haven't decided yet might not get a bed
+            'waitlist': free < 1 or (free == 1 and counts['maybe'] > 1),
+        })
+    rows = []
+    for person in event.signups:
+        attendee_data = event.attendee_data(person).value()
+        travel = []
+        for label in ['Anreise', 'Abreise']:
+            travel_data = attendee_data.get(label.lower(), {})
+            travel.append({
+                'label': label,
+                'data': travel_data,
+                'with_person': event.travel_with(person, label.lower()) if travel_data.get('type') == 'with' else None,
+            })
+        rows.append({
+            'person': person,
+            'nights': [
+                {
+                    'night': night['night'],
+                    'going': night['statuses'][person.snowflake][0],
+                    'waitlist': night['waitlist'],
+                }
+                for night in nights
+            ],
+            'room': rooms.get(person) if rooms else None,
+            'travel': travel,
+            'orga': attendee_data.get('orga', []),
+            'proxy': event.proxy(person) if person.is_guest else None,
+            'can_edit': event.can_edit(flask.g.user, person),
+        })
+    return nights, rows
 
 def mensch_or_signup_required(f):
     @functools.wraps(f)
@@ -145,23 +273,23 @@ def setup(index, app):
                     flask.flash('Dein Guthaben reicht nicht aus, um die Anzahlung zu bezahlen.', 'error')
                     return flask.redirect(flask.g.view_node.url)
                 flask.g.user.add_transaction(gefolge_web.util.Transaction.anzahlung(event, -anzahlung))
-                while True:
-                    anzahlung_extra = event.anzahlung_total - event.ausfall
-                    if anzahlung_extra <= gefolge_web.util.Euro():
-                        break
-                    extra_anzahlungen = sorted(filter(lambda kv: kv[1] > event.anzahlung, (
-                        (mensch, gefolge_web.util.Euro(event.attendee_data(mensch).get('anzahlung', event.anzahlung.value)))
-                        for mensch in event.menschen
-                    )), key=lambda kv: (kv[1] % event.anzahlung == gefolge_web.util.Euro(), (kv[1] - anzahlung_extra) % event.anzahlung != gefolge_web.util.Euro(), -kv[1]))
-                    if len(extra_anzahlungen) == 0:
-                        break
-                    iter_mensch, iter_anzahlung = extra_anzahlungen[0]
-                    if iter_anzahlung % event.anzahlung == gefolge_web.util.Euro() or (iter_anzahlung - anzahlung_extra) % event.anzahlung == gefolge_web.util.Euro():
-                        amount = min(anzahlung_extra, iter_anzahlung - event.anzahlung)
-                    else:
-                        amount = min(anzahlung_extra, iter_anzahlung % event.anzahlung)
-                    event.attendee_data(iter_mensch)['anzahlung'] = event.attendee_data(iter_mensch)['anzahlung'].value() - amount.value
-                    iter_mensch.add_transaction(gefolge_web.util.Transaction.anzahlung_return(event, iter_anzahlung - amount - event.anzahlung, amount))
+                signup_snowflakes = {person.snowflake for person in event.signups}
+                menschen = {}
+                for mensch in event.menschen:
+                    menschen.setdefault(mensch.snowflake, mensch)
+                anzahlungen = {
+                    snowflake: gefolge_web.util.Euro(event.attendee_data(mensch).get('anzahlung', event.anzahlung.value))
+                    for snowflake, mensch in menschen.items()
+                }
+                refunds = anzahlung_refunds(event.anzahlung, event.anzahlung_total - event.ausfall, [
+                    (snowflake, iter_anzahlung, snowflake in signup_snowflakes)
+                    for snowflake, iter_anzahlung in anzahlungen.items()
+                ])
+                for snowflake, remaining, amount in refunds:
+                    anzahlungen[snowflake] -= amount
+                    menschen[snowflake].add_transaction(gefolge_web.util.Transaction.anzahlung_return(event, remaining, amount))
+                for snowflake in {snowflake for snowflake, _, _ in refunds}:
+                    event.attendee_data(menschen[snowflake])['anzahlung'] = anzahlungen[snowflake].value
             event.signup(flask.g.user, anzahlung)
             handle_profile_edit(event, flask.g.user, profile_form)
             return flask.redirect((flask.g.view_node / 'mensch' / flask.g.user).url)
@@ -188,7 +316,7 @@ def setup(index, app):
             event.data['programm'][programm_form.url_part.data] = {}
             programmpunkt = gefolge_web.event.programm.Programmpunkt(event, programm_form.url_part.data)
             handle_programm_edit(programmpunkt, programm_form, True)
-            peter.channel_msg(event.channel, 'Neuer Programmpunkt auf {}: {} ({}, <https://gefolge.org/event/{}/programm/{}>)'.format(
+            gefolge_web.outbox.channel_msg(event.channel, 'Neuer Programmpunkt auf {}: {} ({}, <https://gefolge.org/event/{}/programm/{}>)'.format(
                 '<@&{}>'.format(event.data['role']) if 'role' in event.data else event,
                 programmpunkt,
                 'Orga gesucht' if programmpunkt.orga is None else f'Orga: <@{programmpunkt.orga.snowflake}>',
@@ -235,7 +363,7 @@ def setup(index, app):
             gefolge_web.util.log('eventSignupGuest', {'event': event.event_id, **signup_data})
             event.data['menschen'].append(signup_data)
             if event.anzahlung == gefolge_web.util.Euro() or event.orga('Abrechnung').is_treasurer:
-                peter.channel_msg(event.channel, f'<@{flask.g.user.snowflake}> hat {guest_name or f"<@{guest.snowflake}>"} für {event} angemeldet')
+                gefolge_web.outbox.channel_msg(event.channel, f'<@{flask.g.user.snowflake}> hat {guest_name or f"<@{guest.snowflake}>"} für {event} angemeldet')
             if len(guest_name) > 0:
                 guest = gefolge_web.event.model.EventGuest(event, guest_id)
             if event.anzahlung == gefolge_web.util.Euro() or event.orga('Abrechnung').is_treasurer:
@@ -254,7 +382,12 @@ def setup(index, app):
     @event_page.child('mensch', 'Menschen')
     @gefolge_web.util.template('event.menschen')
     def event_menschen(event):
-        return {'event': event}
+        nights, rows = menschen_table(event)
+        return {
+            'event': event,
+            'nights': nights,
+            'rows': rows,
+        }
 
     @event_menschen.children(lambda event, person: event.person(person))
     @gefolge_web.util.template('event.profile')
@@ -292,62 +425,21 @@ def setup(index, app):
     @event_page.child('programm', 'Programm')
     @gefolge_web.util.template('event.programm')
     def event_programm(event):
-        calendar = event.calendar
-        filled_until = None
-        # rows from hour snip_start to hour snip_end are omitted
-        snip_start = 0
-        snip_end = 24
-
-        def calendar_cell(date, hour):
-            nonlocal filled_until
-            nonlocal snip_start
-            nonlocal snip_end
-
-            timestamp = event.timezone.localize(datetime.datetime.combine(date, datetime.time(hour)), is_dst=None)
-            if filled_until is not None and filled_until > timestamp:
-                return '' # this cell is already filled
-            if timestamp < event.start or timestamp >= event.end:
-                return markupsafe.Markup('<td style="background-color: #666666;"></td>')
-            events_starting_now = [
-                calendar_event
-                for calendar_event in calendar
-                if calendar_event.start >= timestamp
-                and calendar_event.start < timestamp + datetime.timedelta(hours=1)
-                and calendar_event.end < calendar_event.start + datetime.timedelta(hours=24)
-            ]
-            if len(events_starting_now) == 0:
-                return markupsafe.Markup('<td></td>') # nothing planned yet
-            elif len(events_starting_now) == 1:
-                calendar_event = more_itertools.one(events_starting_now)
-                hours = math.ceil((min(calendar_event.end, event.timezone.localize(datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time()), is_dst=None)) - timestamp) / datetime.timedelta(hours=1))
-                filled_until = timestamp + datetime.timedelta(hours=hours) #TODO support for events that go past midnight
-                if hour < 6 and hour + hours >= 6:
-                    # goes over 06:00, remove snip entirely
-                    snip_start = 6
-                    snip_end = 6
-                if snip_start < hour + hours < 6:
-                    # before 06:00, can only start snip at end hour
-                    snip_start = hour + hours
-                if snip_end > hour >= 6:
-                    # at or after 06:00, must stop snip at start hour
-                    snip_end = hour
-                return markupsafe.Markup('<td rowspan="{}" class="{}">{}{}</td>'.format(hours, calendar_event.css_class, calendar_event.__html__(), '<br />{}'.format(markupsafe.escape(calendar_event.subtitle)) if calendar_event.subtitle else ''))
-            else:
-                #TODO support for events that go past midnight
-                return markupsafe.Markup('<td class="danger">{} Programmpunkte</td>'.format(len(events_starting_now)))
-
-        table = {
-            date: {
-                hour: calendar_cell(date, hour)
-                for hour in range(24)
+        digest = event.timetable_digest
+        timetable = gefolge_web.event.programm.cached_timetable(event, digest)
+        if timetable is None:
+            table, snip_start, snip_end = programm_table(event)
+            timetable = {
+                'table': table,
+                'snip_start': snip_start,
+                'snip_end': snip_end,
+                # the header is rendered for each request since it depends on the viewer's timezone settings
+                'timetable_body_html': gefolge_web.util.render_template('event.programm-table-body', event=event, table=table, snip_start=snip_start, snip_end=snip_end),
             }
-            for date in itertools.chain(event.nights, [event.end.date()])
-        }
+            gefolge_web.event.programm.cache_timetable(event, digest, timetable)
         return {
             'event': event,
-            'snip_start': snip_start,
-            'snip_end': snip_end,
-            'table': table
+            **timetable,
         }
 
     @event_programm.children(gefolge_web.event.programm.Programmpunkt.from_url_part_or_name, methods=['GET', 'POST'])
@@ -398,6 +490,7 @@ def setup(index, app):
                 'programmpunkt': programmpunkt.url_part
             })
             del event.data['programm'][programmpunkt.url_part]
+            gefolge_web.event.programm.invalidate_timetable(event)
             return flask.redirect(flask.g.view_node.parent.parent.url)
         else:
             return {
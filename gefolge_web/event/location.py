@@ -1,7 +1,6 @@
 import dataclasses
 
 import markupsafe # PyPI: MarkupSafe
-import more_itertools # PyPI: more-itertools
 import pytz # PyPI: pytz
 
 import gefolge_web.db
@@ -101,9 +100,8 @@ class EventRooms:
         return 'rooms' in self.location.data
 
     def __iter__(self):
-        for section in self.location.data.get('rooms', {}).values():
-            for room_name in section:
-                yield self.room(room_name)
+        for room_name in self.sections:
+            yield self.room(room_name)
 
     def get(self, person):
         data = self.event.attendee_data(person)
@@ -111,9 +109,46 @@ class EventRooms:
             return None
         return self.room(data['room'].value())
 
+    @property
+    def night_occupancy(self):
+        """Maps room names to dicts mapping each night of the event (as YYYY-MM-DD) to the number of people in that room who aren't known to be absent that night. Rebuilt when the event data changes."""
+        def compute(value):
+            result = {}
+            for night, (statuses, _) in self.event.night_matrix.items():
+                for room_name, people in self.occupants.items():
+                    result.setdefault(room_name, {})[night] = sum(1 for person in people if statuses[person.snowflake][0] != 'no')
+            return result
+
+        return self.event.data.memoize('roomNightOccupancy', compute)
+
+    @property
+    def occupants(self):
+        """Maps room names to the people assigned to them, in order of signup. Rebuilt when the event data changes."""
+        def compute(value):
+            result = {}
+            for person in self.event.signups:
+                room_name = self.event.attendee_data(person).get('room')
+                if room_name is not None:
+                    result.setdefault(room_name, []).append(person)
+            return result
+
+        return self.event.data.memoize('roomOccupants', compute)
+
     def room(self, room_name):
         return Room(self.location, self.event, room_name)
 
+    @property
+    def sections(self):
+        """Maps room names to the names of the sections containing them, in order. Rebuilt when the location data changes."""
+        def compute(value):
+            return {
+                room_name: section_name
+                for section_name, section in value.get('rooms', {}).items()
+                for room_name in section
+            }
+
+        return self.location.data.memoize('roomSections', compute)
+
 @dataclasses.dataclass(frozen=True)
 class Room:
     location: Location
@@ -129,36 +164,34 @@ class Room:
 
     @property
     def data(self):
-        return more_itertools.one(
-            section
-            for section in self.location.data['rooms']
-            if self.name in section
-        )[self.name]
+        return self.location.data['rooms'][self.section][self.name]
 
     @property
     def description(self):
         return f'Zimmer {self} ({self.section}, {self.free} von {self.beds} Betten frei)'
 
     @property
-    def free(self): #TODO night-based
-        return self.beds - len(self.people)
+    def free(self):
+        """The number of beds that are free on every night of the event. People who said they won't be there on a night don't occupy a bed on that night."""
+        occupancy = self.rooms.night_occupancy.get(self.name, {})
+        if occupancy:
+            return self.beds - max(occupancy.values())
+        else:
+            return self.beds - len(self.people)
 
     @property
-    def people(self): #TODO night-based
-        return [
-            person
-            for person in self.event.signups
-            if self.event.attendee_data(person).get('room') == self.name
-        ]
+    def people(self):
+        """Everyone assigned to this room, regardless of which nights they're there."""
+        return list(self.rooms.occupants.get(self.name, []))
 
     @property
     def reserved(self):
         return self.data.get('reserved', False)
 
+    @property
+    def rooms(self):
+        return EventRooms(self.location, self.event)
+
     @property
     def section(self):
-        return more_itertools.one(
-            section
-            for section in self.location.data['rooms']
-            if self.name in section
-        ).key
+        return self.rooms.sections[self.name]
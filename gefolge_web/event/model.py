@@ -1,17 +1,19 @@
+import collections
 import datetime
+import hashlib
 import itertools
-import subprocess
 
 import flask # PyPI: Flask
 import icalendar # PyPI: icalendar
 import markupsafe # PyPI: MarkupSafe
 import pytz # PyPI: pytz
+import simplejson # PyPI: simplejson
 
 import class_key # https://github.com/fenhl/python-class-key
-import peter # https://github.com/dasgefolge/peter-discord
 
 import gefolge_web.db
 import gefolge_web.login
+import gefolge_web.outbox
 import gefolge_web.person
 import gefolge_web.util
 
@@ -22,7 +24,7 @@ class EventGuest(gefolge_web.person.Guest):
     def __init__(self, event, guest_id):
         self.event = event
         self.snowflake = int(guest_id) # not actually a snowflake but uses this variable name for compatibility with the DiscordPerson class
-        if not any('via' in person and person['id'] == self.snowflake for person in event.data.get('menschen', [])):
+        if self.snowflake not in event.guest_ids:
             raise ValueError(f'Es gibt keinen Gast mit ID {self.snowflake!r} im event {self.event!r}.')
 
     def __eq__(self, other):
@@ -47,20 +49,57 @@ class EventGuest(gefolge_web.person.Guest):
 class EventMeta(type):
     def __iter__(self):
         # iterating over the Event class yields all events
-        return iter(sorted(
-            Event(event_id)
-            for event_id in subprocess.run(['/home/fenhl/bin/gefolge-web-back', 'events', 'list'], stdout=subprocess.PIPE, encoding='utf-8', check=True).stdout.splitlines()
-        ))
+        return iter(self.select())
 
 @class_key.class_key()
 class Event(metaclass=EventMeta):
-    def __init__(self, event_id):
+    def __init__(self, event_id, *, check_exists=True):
+        """If `check_exists` is false, the event data isn't loaded until it's needed, so attribute access may raise FileNotFoundError later instead. Use `Event.exists` or `Event.resolve` to check many events at once."""
         self.event_id = event_id
-        self.data.value() # make sure event exists
+        if check_exists:
+            self.data.value() # make sure event exists
 
     def __html__(self):
         return markupsafe.Markup('<a href="{}">{}</a>'.format(flask.url_for('event_page', event=self.event_id), self))
 
+    @classmethod
+    def attended_by(cls, person):
+        """Returns the events the given person has completed signup for, in chronological order. Only those events are loaded, using the events index."""
+        return [
+            event
+            for event in cls.select(attendee=person)
+            if person in event.signups
+        ]
+
+    @classmethod
+    def exists(cls, event_ids):
+        """Returns the set of those of the given event IDs that exist. All events are loaded in a single query, so constructing them afterwards doesn't query the database again."""
+        return set(gefolge_web.util.prefetch_json('events', event_ids))
+
+    @classmethod
+    def resolve(cls, event_ids):
+        """Returns a dict mapping each of the given event IDs to its event, or to `None` if it doesn't exist. All events are loaded in a single query."""
+        event_ids = set(event_ids)
+        existing = cls.exists(event_ids)
+        return {
+            event_id: cls(event_id, check_exists=False) if event_id in existing else None
+            for event_id in event_ids
+        }
+
+    @classmethod
+    def select(cls, *, upcoming=None, attendee=None):
+        """Returns events in chronological order, as sorted by the events index in the database rather than by parsing their start and end times.
+
+        If `upcoming` is true, only events which haven't ended yet are included; if it's false, only those which have. If `attendee` is given, only events that person has signed up for are included. Only the selected events are loaded, in a single query.
+        """
+        event_ids = gefolge_web.db.BACKEND.event_ids(upcoming=upcoming, attendee=None if attendee is None else attendee.snowflake)
+        existing = cls.exists(event_ids)
+        return [
+            cls(event_id, check_exists=False)
+            for event_id in event_ids
+            if event_id in existing
+        ]
+
     @property
     def __key__(self):
         return self.start is None, self.start, self.end is None, self.end, self.event_id
@@ -91,10 +130,20 @@ class Event(metaclass=EventMeta):
         ), gefolge_web.util.Euro())
 
     def attendee_data(self, person):
-        if 'menschen' in self.data:
-            for iter_data in self.data['menschen']:
-                if str(iter_data['id'].value()) == str(person.snowflake):
-                    return iter_data
+        index = self.attendee_index.get(str(person.snowflake))
+        if index is not None:
+            return self.data['menschen'][index]
+
+    @property
+    def attendee_index(self):
+        """Maps the snowflakes of attendees, as strings, to their positions in the `menschen` list. Rebuilt when the event data changes."""
+        def compute(value):
+            index = {}
+            for i, person in enumerate(value.get('menschen', [])):
+                index.setdefault(str(person['id']), i)
+            return index
+
+        return self.data.memoize('attendeeIndex', compute)
 
     @property
     def ausfall(self):
@@ -174,9 +223,9 @@ class Event(metaclass=EventMeta):
         })
         self.attendee_data(guest)['signup'] = f'{gefolge_web.util.now(self.timezone):%Y-%m-%dT%H:%M:%S}' #TODO Datum der Überweisung verwenden
         if guest.is_active and 'role' in self.data:
-            peter.add_role(guest, int(self.data['role'].value()))
+            gefolge_web.outbox.add_role(guest, int(self.data['role'].value()))
         if message:
-            peter.channel_msg(self.channel, '<@{proxy_snowflake}>: {guest} ist jetzt für {event} angemeldet. Fülle bitte bei Gelegenheit noch das Profil auf <https://gefolge.org/event/{event_id}/mensch/{guest_snowflake}/edit> aus. Außerdem kannst du {guest} auf <https://gefolge.org/event/{event_id}/programm> für Programmpunkte als interessiert eintragen'.format(
+            gefolge_web.outbox.channel_msg(self.channel, '<@{proxy_snowflake}>: {guest} ist jetzt für {event} angemeldet. Fülle bitte bei Gelegenheit noch das Profil auf <https://gefolge.org/event/{event_id}/mensch/{guest_snowflake}/edit> aus. Außerdem kannst du {guest} auf <https://gefolge.org/event/{event_id}/programm> für Programmpunkte als interessiert eintragen'.format(
                 proxy_snowflake=self.proxy(guest).snowflake,
                 guest=f'<@{guest.snowflake}>' if guest.is_active else guest,
                 event=self,
@@ -188,6 +237,11 @@ class Event(metaclass=EventMeta):
     def data(self):
         return gefolge_web.util.cached_json(gefolge_web.db.PgFile('events', self.event_id))
 
+    @property
+    def digest(self):
+        """A digest of the event data. Rebuilt when the event data changes."""
+        return self.data.memoize('digest', lambda value: hashlib.sha256(simplejson.dumps(value, use_decimal=True, sort_keys=True).encode('utf-8')).hexdigest())
+
     @property
     def end(self):
         if 'end' in self.data:
@@ -210,7 +264,7 @@ class Event(metaclass=EventMeta):
         if start is None:
             start = self.start.date()
         return min(
-            self.capacity(night) - len(self.night_signups(night))
+            self.capacity(night) - self.night_status(night)[1]['yes']
             for night in gefolge_web.util.date_range(start, end)
         )
 
@@ -218,13 +272,21 @@ class Event(metaclass=EventMeta):
     def guest_signup_block_reason(self):
         return self.data.get('guestSignupBlockReason', self.data.get('signupBlockReason'))
 
+    @property
+    def guest_ids(self):
+        """The IDs of all guests, as a set. Rebuilt when the event data changes."""
+        return self.data.memoize('guestIDs', lambda value: {person['id'] for person in value.get('menschen', []) if 'via' in person})
+
     @property
     def guests(self):
-        return [
-            EventGuest(self, person['id']) if person['id'] < 100 else gefolge_web.login.DiscordGuest(person['id'])
-            for person in self.data.get('menschen', [])
-            if 'via' in person
-        ]
+        def compute(value):
+            return [
+                EventGuest(self, person['id']) if person['id'] < 100 else gefolge_web.login.DiscordGuest(person['id'])
+                for person in value.get('menschen', [])
+                if 'via' in person
+            ]
+
+        return list(self.data.memoize('guests', compute))
 
     @property
     def location(self):
@@ -236,14 +298,20 @@ class Event(metaclass=EventMeta):
 
     @property
     def menschen(self):
-        return [
-            gefolge_web.login.Mensch(person['id'])
-            for person in self.data.get('menschen', [])
-            if 'via' not in person
-        ]
+        def compute(value):
+            return [
+                gefolge_web.login.Mensch(person['id'])
+                for person in value.get('menschen', [])
+                if 'via' not in person
+            ]
+
+        return list(self.data.memoize('menschen', compute))
 
     def night_going(self, attendee_data, night):
         if hasattr(attendee_data, 'snowflake'):
+            statuses, _ = self.night_status(night)
+            if attendee_data.snowflake in statuses:
+                return statuses[attendee_data.snowflake][0]
             attendee_data = self.attendee_data(attendee_data)
         result = attendee_data.get('nights', {}).get('{:%Y-%m-%d}'.format(night), {'going': 'maybe', 'lastUpdated': None})
         if isinstance(result, dict):
@@ -261,28 +329,67 @@ class Event(metaclass=EventMeta):
 
     def night_status_change(self, attendee_data, night):
         if hasattr(attendee_data, 'snowflake'):
-            attendee_data = self.attendee_data(attendee_data)
-        result = attendee_data.get('nights', {}).get('{:%Y-%m-%d}'.format(night), {'going': 'maybe', 'lastUpdated': None})
-        if isinstance(result, str):
-            result = None
+            statuses, _ = self.night_status(night)
+            if attendee_data.snowflake in statuses:
+                result = statuses[attendee_data.snowflake][1]
+            else:
+                return self.night_status_change(self.attendee_data(attendee_data), night)
         else:
-            result = result['lastUpdated']
+            result = attendee_data.get('nights', {}).get('{:%Y-%m-%d}'.format(night), {'going': 'maybe', 'lastUpdated': None})
+            if isinstance(result, str):
+                result = None
+            else:
+                result = result['lastUpdated']
         if result is not None:
             return gefolge_web.util.parse_iso_datetime(result, tz=pytz.utc)
 
+    @property
+    def night_matrix(self):
+        """Maps each night of the event (as YYYY-MM-DD) to the result of `night_status` for that night. Rebuilt when the event data changes."""
+        def compute(value):
+            if self.start is None or self.end is None:
+                return {}
+            return {
+                f'{night:%Y-%m-%d}': self.compute_night_status(value, night)
+                for night in self.nights
+            }
+
+        return self.data.memoize('nightMatrix', compute)
+
+    def compute_night_status(self, value, night):
+        menschen = value.get('menschen', [])
+        index = self.attendee_index
+        statuses = {}
+        for snowflake, _ in self.signup_ids:
+            status = menschen[index[str(snowflake)]].get('nights', {}).get(f'{night:%Y-%m-%d}', {'going': 'maybe', 'lastUpdated': None})
+            if isinstance(status, str):
+                statuses[snowflake] = status, None
+            else:
+                statuses[snowflake] = status['going'], status['lastUpdated']
+        return statuses, collections.Counter(going for going, _ in statuses.values())
+
     def night_maybes(self, night):
+        return self.night_people(night, {'maybe'})
+
+    def night_people(self, night, going):
+        """Returns everyone who has completed signup and whose status for the given night is in `going`, in order of signup."""
+        statuses, _ = self.night_status(night)
         return [
             person
             for person in self.signups
-            if self.night_going(person, night) == 'maybe'
+            if statuses[person.snowflake][0] in going
         ]
 
     def night_signups(self, night):
-        return [
-            person
-            for person in self.signups
-            if self.night_going(person, night) == 'yes'
-        ]
+        return self.night_people(night, {'yes'})
+
+    def night_status(self, night):
+        """Returns a dict mapping the IDs of everyone who has completed signup to their status for the given night ('yes', 'maybe' or 'no') and when it was last changed, as well as a Counter of the statuses."""
+        result = self.night_matrix.get(f'{night:%Y-%m-%d}')
+        if result is None:
+            # not a night of the event, so not precomputed
+            result = self.compute_night_status(self.data.value(), night)
+        return result
 
     @property
     def nights(self):
@@ -359,35 +466,75 @@ class Event(metaclass=EventMeta):
             person_data['anzahlung'] = anzahlung.value
         self.data['menschen'].append(person_data)
         if 'role' in self.data:
-            peter.add_role(mensch, int(self.data['role'].value()))
+            gefolge_web.outbox.add_role(mensch, int(self.data['role'].value()))
         if self.orga('Abrechnung').is_treasurer:
-            peter.channel_msg(self.channel, '<@{}>: du bist jetzt für {} angemeldet. Du kannst dich auf <https://gefolge.org/event/{}/programm> für Programmpunkte als interessiert eintragen'.format(mensch.snowflake, self, self.event_id))
+            gefolge_web.outbox.channel_msg(self.channel, '<@{}>: du bist jetzt für {} angemeldet. Du kannst dich auf <https://gefolge.org/event/{}/programm> für Programmpunkte als interessiert eintragen'.format(mensch.snowflake, self, self.event_id))
         else:
-            peter.channel_msg(self.channel, '<@{}>: du bist jetzt für {} angemeldet. Fülle bitte bei Gelegenheit noch dein Profil auf <https://gefolge.org/event/{}/me/edit> aus. Außerdem kannst du dich auf <https://gefolge.org/event/{}/programm> für Programmpunkte als interessiert eintragen'.format(mensch.snowflake, self, self.event_id, self.event_id))
+            gefolge_web.outbox.channel_msg(self.channel, '<@{}>: du bist jetzt für {} angemeldet. Fülle bitte bei Gelegenheit noch dein Profil auf <https://gefolge.org/event/{}/me/edit> aus. Außerdem kannst du dich auf <https://gefolge.org/event/{}/programm> für Programmpunkte als interessiert eintragen'.format(mensch.snowflake, self, self.event_id, self.event_id))
 
     @property
     def signup_block_reason(self):
         return self.data.get('signupBlockReason')
 
+    @property
+    def signup_ids(self):
+        """The IDs of everyone who has completed signup, including guests, in order of signup, as (ID, is_guest) pairs. Rebuilt when the event data changes."""
+        def compute(value):
+            menschen = value.get('menschen', [])
+            index = self.attendee_index
+            result = {}
+            for person in menschen:
+                if 'via' in person:
+                    attendee_data = menschen[index[str(person['id'])]]
+                    if 'signup' in attendee_data:
+                        result[person['id']] = True, attendee_data['signup']
+            for person in menschen:
+                if 'via' not in person:
+                    result[person['id']] = result.get(person['id'], (False, None))[0], menschen[index[str(person['id'])]]['signup']
+            return [(snowflake, is_guest) for snowflake, (is_guest, signup) in sorted(result.items(), key=lambda kv: kv[1][1])]
+
+        return self.data.memoize('signupIDs', compute)
+
+    def signup_person(self, snowflake, is_guest):
+        if is_guest:
+            return EventGuest(self, snowflake) if snowflake < 100 else gefolge_web.login.DiscordGuest(snowflake)
+        else:
+            return gefolge_web.login.Mensch(snowflake)
+
     @property
     def signups(self):
         """Returns everyone who has completed signup, including guests, in order of signup."""
-        result = {
-            guest: self.attendee_data(guest)['signup'].value()
-            for guest in self.guests
-            if 'signup' in self.attendee_data(guest)
-        }
-        result.update({
-            mensch: self.attendee_data(mensch)['signup'].value()
-            for mensch in self.menschen
-        })
-        return [person for person, signup in sorted(result.items(), key=lambda kv: kv[1])]
+        def compute(value):
+            return [self.signup_person(snowflake, is_guest) for snowflake, is_guest in self.signup_ids]
+
+        return list(self.data.memoize('signups', compute))
 
     @property
     def start(self):
         if 'start' in self.data:
             return gefolge_web.util.parse_iso_datetime(self.data['start'].value(), tz=self.timezone)
 
+    @property
+    def timetable_digest(self):
+        """A digest of the parts of the event data the Programm timetable is computed from, together with the version of the location, which determines the timezone and the Endreinigung. The part for the event data is rebuilt when the event data changes.
+
+        `None` if the location has been modified during this request, so the timetable can't be cached.
+        """
+        def compute(value):
+            return hashlib.sha256(simplejson.dumps([
+                value.get(key)
+                for key in ('programm', 'essen', 'start', 'end', 'timezone', 'location')
+            ], use_decimal=True, sort_keys=True).encode('utf-8')).hexdigest()
+
+        location = self.location
+        if location is None or location.is_online:
+            location_version = None
+        else:
+            location_version = location.data.version()
+            if location_version is None:
+                return None
+        return self.data.memoize('timetableDigest', compute), location_version
+
     @property
     def timezone(self):
         if 'timezone' in self.data:
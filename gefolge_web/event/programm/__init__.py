@@ -1,4 +1,6 @@
+import collections
 import re
+import threading
 
 import challonge # PyPI: pychallonge
 import flask # PyPI: Flask
@@ -10,12 +12,42 @@ import pytz # PyPI: pytz
 import wtforms # PyPI: WTForms
 
 import class_key # https://github.com/fenhl/python-class-key
-import peter # https://github.com/dasgefolge/peter-discord
 
 import gefolge_web.forms
 import gefolge_web.login
+import gefolge_web.outbox
 import gefolge_web.util
 
+MAX_TIMETABLES = 64
+TIMETABLES = collections.OrderedDict() # event ID → (digest, timetable), the most recently used rendered Programm timetables of events. Each entry is only valid as long as the event's timetable_digest matches.
+TIMETABLES_LOCK = threading.Lock()
+
+def cache_timetable(event, digest, timetable):
+    """Caches the rendered Programm timetable of the given event, dropping the least recently used timetable if there are more than `MAX_TIMETABLES`."""
+    if digest is None:
+        return
+    with TIMETABLES_LOCK:
+        TIMETABLES[event.event_id] = digest, timetable
+        TIMETABLES.move_to_end(event.event_id)
+        while len(TIMETABLES) > MAX_TIMETABLES:
+            TIMETABLES.popitem(last=False)
+
+def cached_timetable(event, digest):
+    """Returns the cached Programm timetable of the given event, or `None` if it's not cached for the given digest."""
+    if digest is None:
+        return None
+    with TIMETABLES_LOCK:
+        cached = TIMETABLES.get(event.event_id)
+        if cached is None or cached[0] != digest:
+            return None
+        TIMETABLES.move_to_end(event.event_id)
+        return cached[1]
+
+def invalidate_timetable(event):
+    """Drops the cached Programm timetable of the given event. Other processes notice the change through the digest instead."""
+    with TIMETABLES_LOCK:
+        TIMETABLES.pop(event.event_id, None)
+
 @class_key.class_key()
 class CalendarEvent:
     def __init__(self, programmpunkt, uid, text, html, start, end):
@@ -164,7 +196,7 @@ class Programmpunkt:
         if isinstance(event, str):
             import gefolge_web.event.model
 
-            self.event = gefolge_web.event.model.Event(event)
+            self.event = gefolge_web.event.model.Event(event, check_exists=False) # assert_exists loads the event data anyway
         else:
             self.event = event
         self.url_part = programmpunkt
@@ -452,10 +484,10 @@ class Programmpunkt:
                         self.data['startggSlugs'] = {}
                     self.data['startggSlugs'][str(person_to_signup.snowflake)] = form.startgg_slug.data
                     if self.orga is not None:
-                        peter.msg(self.orga, '<@{}> ({}) hat sich für {} auf {} angemeldet. (start.gg-Profil: {})'.format(person_to_signup.snowflake, person_to_signup, self, self.event, form.startgg_slug.data)) #TODO fix recipient if guest, fix formatting for EventGuests (dm_mention)
+                        gefolge_web.outbox.msg(self.orga, '<@{}> ({}) hat sich für {} auf {} angemeldet. (start.gg-Profil: {})'.format(person_to_signup.snowflake, person_to_signup, self, self.event, form.startgg_slug.data)) #TODO fix recipient if guest, fix formatting for EventGuests (dm_mention)
                 else:
                     if self.orga is not None:
-                        peter.msg(self.orga, '<@{}> ({}) hat sich für {} auf {} angemeldet. (kein start.gg-Profil)'.format(person_to_signup.snowflake, person_to_signup, self, self.event)) #TODO fix recipient if guest, fix formatting for EventGuests (dm_mention)
+                        gefolge_web.outbox.msg(self.orga, '<@{}> ({}) hat sich für {} auf {} angemeldet. (kein start.gg-Profil)'.format(person_to_signup.snowflake, person_to_signup, self, self.event)) #TODO fix recipient if guest, fix formatting for EventGuests (dm_mention)
             self.signup(person_to_signup)
 
         self.process_form_details(form, editor)
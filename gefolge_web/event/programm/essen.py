@@ -61,6 +61,7 @@ class Abendessen(gefolge_web.event.programm.Programmpunkt):
     @css_class.setter
     def css_class(self, value):
         self.data['cssClass'] = value
+        gefolge_web.event.programm.invalidate_timetable(self.event)
 
     @property
     def data(self):
@@ -96,6 +97,7 @@ class Abendessen(gefolge_web.event.programm.Programmpunkt):
         if '{:%Y-%m-%d}'.format(self.date) not in self.event.data['essen']:
             self.event.data['essen']['{:%Y-%m-%d}'.format(self.date)] = {}
         self.event.data['essen']['{:%Y-%m-%d}'.format(self.date)]['dinnerEnd'] = '{:%Y-%m-%dT%H:%M:%S}'.format(value)
+        gefolge_web.event.programm.invalidate_timetable(self.event)
 
     @end.deleter
     def end(self):
@@ -138,13 +140,7 @@ class Abendessen(gefolge_web.event.programm.Programmpunkt):
 
     @property
     def signups(self):
-        night_maybes = self.event.night_signups(self.date) + self.event.night_maybes(self.date)
-        return [
-            person
-            for person in self.event.signups
-            if person in night_maybes
-            #TODO Selbstversorger
-        ]
+        return self.event.night_people(self.date, {'yes', 'maybe'}) #TODO Selbstversorger
 
     @property
     def start(self):
@@ -164,6 +160,7 @@ class Abendessen(gefolge_web.event.programm.Programmpunkt):
         if '{:%Y-%m-%d}'.format(self.date) not in self.event.data['essen']:
             self.event.data['essen']['{:%Y-%m-%d}'.format(self.date)] = {}
         self.event.data['essen']['{:%Y-%m-%d}'.format(self.date)]['dinnerStart'] = '{:%Y-%m-%dT%H:%M:%S}'.format(value)
+        gefolge_web.event.programm.invalidate_timetable(self.event)
 
     @start.deleter
     def start(self):
@@ -1,7 +1,6 @@
 import functools
 import random
 import string
-import subprocess
 import urllib.parse
 
 import flask # PyPI: Flask
@@ -19,6 +18,7 @@ import peter # https://github.com/dasgefolge/peter-discord
 
 import gefolge_web.db
 import gefolge_web.forms
+import gefolge_web.outbox
 import gefolge_web.person
 import gefolge_web.util
 
@@ -45,16 +45,51 @@ class User(gefolge_web.person.Person):
     def userdata(self):
         return lazyjson.PythonFile({})
 
+BALANCES = {} # maps snowflakes to (user data version, balance), shared between requests
+PROFILES = None # (table version, profiles) as returned by all_profiles, shared between requests
+TREASURER_BALANCE = None # ((user data table version, profiles table version), balance), shared between requests
+
 class DiscordPersonMeta(type):
     def __iter__(self):
         # iterating over the DiscordPerson class yields everyone in the guild
         return (
             DiscordPerson(snowflake)
-            for snowflake in subprocess.run(['/home/fenhl/bin/gefolge-web-back', 'profiles', 'list'], stdout=subprocess.PIPE, encoding='utf-8', check=True).stdout.splitlines()
+            for snowflake in all_profiles()
         )
 
+def all_profiles():
+    """Returns a dict mapping the snowflakes of everyone in the guild to their profile data.
+
+    The profiles are loaded in a single query and reused until one of them changes, or until the end of the request if changes can't be detected. They must not be modified.
+    """
+    global PROFILES
+
+    cache = gefolge_web.db.SHARED_CACHE
+    version = None if cache is None else cache.table_version('profiles')
+    if version is not None and PROFILES is not None and PROFILES[0] == version:
+        return PROFILES[1]
+    try:
+        if hasattr(flask.g, 'profiles'):
+            return flask.g.profiles
+    except RuntimeError:
+        in_request = False
+    else:
+        in_request = True
+    profiles = {
+        snowflake: value
+        for snowflake, (value, _) in gefolge_web.db.PgFile.get_many('profiles').items()
+    }
+    if version is not None:
+        PROFILES = version, profiles
+    if in_request:
+        flask.g.profiles = profiles
+    return profiles
+
 def profile_data_for_snowflake(snowflake):
-    return gefolge_web.util.cached_json(gefolge_web.db.PgFile('profiles', snowflake)).value()
+    try:
+        return all_profiles()[int(snowflake)]
+    except KeyError:
+        raise gefolge_web.db.not_found('profiles', snowflake) from None
 
 class DiscordPerson(User, metaclass=DiscordPersonMeta):
     def __new__(cls, snowflake):
@@ -113,6 +148,7 @@ class DiscordPerson(User, metaclass=DiscordPersonMeta):
     @gefolge_web.person.Person.api_key.deleter
     def api_key(self):
         if 'apiKey' in self.userdata:
+            gefolge_web.person.API_KEYS.pop(self.userdata['apiKey'].value(), None)
             del self.userdata['apiKey']
 
     @property
@@ -190,11 +226,13 @@ class DiscordPerson(User, metaclass=DiscordPersonMeta):
 class MenschMeta(DiscordPersonMeta):
     def __iter__(self):
         # iterating over the Mensch class yields everyone with the role
-        return (
+        menschen = [
             person
             for person in DiscordPerson
             if person.is_mensch
-        )
+        ]
+        gefolge_web.util.prefetch_json('user-data', [mensch.snowflake for mensch in menschen])
+        return iter(menschen)
 
 class Mensch(DiscordPerson, metaclass=MenschMeta):
     def __new__(cls, snowflake):
@@ -214,21 +252,79 @@ class Mensch(DiscordPerson, metaclass=MenschMeta):
         return f'gefolge_web.login.Mensch({self.snowflake!r})'
 
     def add_transaction(self, transaction):
+        if self.is_treasurer or not flask.has_request_context():
+            # the treasurer's balance is computed from everyone else's, and outside of requests there's nowhere to keep it
+            balance = None
+        else:
+            balance = self.balance
         if 'transactions' not in self.userdata:
             self.userdata['transactions'] = []
         self.userdata['transactions'].append(transaction.json_data)
+        if balance is None:
+            return
+        # the version of the user data after this request is unknown, so keep the new balance for the rest of the request
+        if not hasattr(flask.g, 'balances'):
+            flask.g.balances = {}
+        flask.g.balances[self.snowflake] = balance + transaction.amount
 
     @property
     def balance(self):
+        global TREASURER_BALANCE
+
         if self.is_treasurer:
-            return sum((
-                # Guthaben aller anderen Menschen (ohne Schulden)
-                -mensch.balance
-                for mensch in Mensch
-                if not mensch.is_treasurer and mensch.balance > gefolge_web.util.Euro()
-            ), gefolge_web.util.Euro())
-        else:
-            return sum((transaction.amount for transaction in self.transactions), gefolge_web.util.Euro())
+            cache = gefolge_web.db.SHARED_CACHE
+            if cache is None or not flask.has_request_context() or gefolge_web.util.db_batch().modified('user-data') or gefolge_web.util.db_batch().modified('profiles'):
+                version = None
+            else:
+                # roles in the profiles determine who's included
+                version = cache.table_version('user-data'), cache.table_version('profiles')
+                if None in version:
+                    version = None
+            if version is not None and TREASURER_BALANCE is not None and TREASURER_BALANCE[0] == version:
+                return TREASURER_BALANCE[1]
+            balance = gefolge_web.util.Euro()
+            for mensch in Mensch:
+                if not mensch.is_treasurer:
+                    mensch_balance = mensch.balance
+                    if mensch_balance > gefolge_web.util.Euro():
+                        balance -= mensch_balance # Guthaben aller anderen Menschen (ohne Schulden)
+            if version is not None:
+                TREASURER_BALANCE = version, balance
+            return balance
+        if not flask.has_request_context():
+            # rows aren't loaded through a batch outside of requests, so there's no version to check the cache against
+            return self.transactions_total()
+        if self.snowflake in getattr(flask.g, 'balances', {}):
+            return flask.g.balances[self.snowflake]
+        version = self.userdata_version
+        if version is not None and self.snowflake in BALANCES:
+            cached_version, balance = BALANCES[self.snowflake]
+            if cached_version == version:
+                return balance
+        balance = self.transactions_total()
+        if version is not None:
+            BALANCES[self.snowflake] = version, balance
+        return balance
+
+    @classmethod
+    def check_balances(cls):
+        """Recomputes the cached balances of all Menschen from their transactions. Returns a list of (mensch, cached balance, actual balance) for each cached balance that was wrong."""
+        global TREASURER_BALANCE
+
+        mismatches = []
+        for mensch in cls:
+            if mensch.is_treasurer:
+                continue
+            actual = mensch.transactions_total()
+            version = mensch.userdata_version
+            if mensch.snowflake in BALANCES:
+                cached_version, cached = BALANCES[mensch.snowflake]
+                if cached_version == version and cached != actual:
+                    mismatches.append((mensch, cached, actual))
+            if version is not None:
+                BALANCES[mensch.snowflake] = version, actual
+        TREASURER_BALANCE = None
+        return mismatches
 
     @property
     def is_active(self):
@@ -241,6 +337,17 @@ class Mensch(DiscordPerson, metaclass=MenschMeta):
             for transaction_data in self.userdata.get('transactions', [])
         ]
 
+    @property
+    def userdata_version(self):
+        """The version of the user data row as loaded in this request, or `None` if unknown or modified."""
+        userdata = self.userdata
+        if isinstance(userdata, gefolge_web.db.BatchedFile):
+            return userdata.version()
+
+    def transactions_total(self):
+        """Computes the balance from the transactions, without using the cache."""
+        return sum((transaction.amount for transaction in self.transactions), gefolge_web.util.Euro())
+
     @property
     def twitch(self):
         return self.userdata.get('twitch')
@@ -421,15 +528,17 @@ def setup(index, app):
         if not person.is_active:
             return gefolge_web.util.render_template('profile-404', mensch=person), 404
         if person.is_mensch and (flask.g.user.is_admin or flask.g.user.is_treasurer or flask.g.user == person):
+            transactions_page = max(0, flask.request.args.get('transactions_page', 0, type=int))
+            transactions, transactions_pages = gefolge_web.util.render_transactions(person, transactions_page)
             transfer_money_form = TransferMoneyForm(person)
             if transfer_money_form.submit_transfer_money_form.data and transfer_money_form.validate():
                 recipient = transfer_money_form.recipient.data
                 person.add_transaction(gefolge_web.util.Transaction.transfer(recipient, -transfer_money_form.amount.data, transfer_money_form.comment.data))
                 recipient.add_transaction(gefolge_web.util.Transaction.transfer(person, transfer_money_form.amount.data, transfer_money_form.comment.data))
                 if flask.g.user != person:
-                    peter.msg(person, '<@{}> ({}) hat {} von deinem Guthaben an <@{}> ({}) übertragen. {}: <https://gefolge.org/me>'.format(flask.g.user.snowflake, flask.g.user, transfer_money_form.amount.data, recipient.snowflake, recipient, 'Kommentar und weitere Infos' if transfer_money_form.comment.data else 'Weitere Infos'))
+                    gefolge_web.outbox.msg(person, '<@{}> ({}) hat {} von deinem Guthaben an <@{}> ({}) übertragen. {}: <https://gefolge.org/me>'.format(flask.g.user.snowflake, flask.g.user, transfer_money_form.amount.data, recipient.snowflake, recipient, 'Kommentar und weitere Infos' if transfer_money_form.comment.data else 'Weitere Infos'))
                 if flask.g.user != recipient:
-                    peter.msg(recipient, '<@{}> ({}) hat {} an dich übertragen. {}: <https://gefolge.org/me>'.format(person.snowflake, person, transfer_money_form.amount.data, 'Kommentar und weitere Infos' if transfer_money_form.comment.data else 'Weitere Infos'))
+                    gefolge_web.outbox.msg(recipient, '<@{}> ({}) hat {} an dich übertragen. {}: <https://gefolge.org/me>'.format(person.snowflake, person, transfer_money_form.amount.data, 'Kommentar und weitere Infos' if transfer_money_form.comment.data else 'Weitere Infos'))
                 return flask.redirect(flask.g.view_node.url)
             wurstmineberg_transfer_money_form = WurstminebergTransferMoneyForm(person)
             if wurstmineberg_transfer_money_form.submit_wurstmineberg_transfer_money_form.data and wurstmineberg_transfer_money_form.validate():
@@ -442,11 +551,17 @@ def setup(index, app):
                     'type': 'gefolge'
                 })
         else:
+            transactions_page = 0
+            transactions = []
+            transactions_pages = 0
             transfer_money_form = None
             wurstmineberg_transfer_money_form = None
         return {
-            'events': [event for event in gefolge_web.event.model.Event if person in event.signups],
+            'events': gefolge_web.event.model.Event.attended_by(person),
             'person': person,
+            'transactions': transactions,
+            'transactions_page': transactions_page,
+            'transactions_pages': transactions_pages,
             'transfer_money_form': transfer_money_form,
             'wurstmineberg_transfer_money_form': wurstmineberg_transfer_money_form
         }
@@ -0,0 +1,158 @@
+import collections
+import datetime
+import os
+import select
+import threading
+import time
+
+import flask # PyPI: Flask
+
+try:
+    import psycopg2 # PyPI: psycopg2
+except ImportError:
+    psycopg2 = None
+
+import peter # https://github.com/dasgefolge/peter-discord
+
+import gefolge_web.util
+
+MAX_ATTEMPTS = 10
+MAX_BACKOFF = datetime.timedelta(hours=1)
+NOTIFY_CHANNEL = 'gefolge_web_outbox' # see assets/discord-outbox.sql
+
+WORKER = None
+# counts of commands handled by the outbox worker of this process since it was started. `latency` is the total time in seconds from enqueueing to sending of the `sent` commands.
+STATS = collections.Counter()
+
+def add_role(user, role_id):
+    enqueue({'cmd': 'add-role', 'user': user_id(user), 'role': int(role_id)})
+
+def channel_msg(channel_id, msg):
+    enqueue({'cmd': 'channel-msg', 'channel': int(channel_id), 'msg': msg})
+
+def msg(user, msg):
+    enqueue({'cmd': 'msg', 'user': user_id(user), 'msg': msg})
+
+def backoff(attempts):
+    return min(datetime.timedelta(seconds=10) * 2 ** (attempts - 1), MAX_BACKOFF)
+
+def enqueue(command):
+    """Sends the given Discord command once the current request's writes are committed. If there's no outbox worker or this isn't called during a request, it's sent right away instead."""
+    if WORKER is None or not flask.has_request_context():
+        run(command)
+    else:
+        gefolge_web.util.db_batch().enqueue(command)
+
+def run(command):
+    if command['cmd'] == 'add-role':
+        peter.add_role(command['user'], command['role'])
+    elif command['cmd'] == 'channel-msg':
+        peter.channel_msg(command['channel'], command['msg'])
+    elif command['cmd'] == 'msg':
+        peter.msg(command['user'], command['msg'])
+    else:
+        raise ValueError(f'Unknown outbox command: {command["cmd"]!r}')
+
+def setup(app):
+    global WORKER
+
+    if psycopg2 is not None and app.config.get('discordOutbox', True): # otherwise, commands are sent during the request
+        WORKER = Worker(app.config['SQLALCHEMY_DATABASE_URI'])
+
+        @app.before_request
+        def start_outbox_worker():
+            # also drain commands left over from before this worker was started
+            WORKER.check_thread()
+
+def stats():
+    """Returns the number of commands waiting to be sent, the number of commands which failed too often to be retried, and the age in seconds of the oldest waiting command, as well as the counts from `STATS`. Returns `None` if there's no outbox worker."""
+    if WORKER is None:
+        return None
+    with psycopg2.connect(WORKER.dsn, application_name='gefolge-web-outbox') as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FILTER (WHERE next_attempt IS NOT NULL), COUNT(*) FILTER (WHERE next_attempt IS NULL), EXTRACT(EPOCH FROM NOW() - MIN(enqueued) FILTER (WHERE next_attempt IS NOT NULL)) FROM discord_outbox')
+            depth, failed, oldest = cur.fetchone()
+    conn.close()
+    return {
+        'depth': depth,
+        'failed': failed,
+        'oldest': None if oldest is None else float(oldest),
+        'meanLatency': STATS['latency'] / STATS['sent'] if STATS['sent'] else None,
+        **STATS,
+    }
+
+def user_id(user):
+    # support gefolge_web.login.Mensch arguments like the peter module does
+    return int(getattr(user, 'snowflake', user))
+
+class Worker:
+    """Sends the commands from the Discord outbox in a background thread of each worker process. Commands are locked while they're being sent, so each is sent by only one process.
+
+    Failed commands are retried with exponential backoff, up to `MAX_ATTEMPTS` times.
+    """
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def __repr__(self):
+        return f'gefolge_web.outbox.Worker({self.dsn!r})'
+
+    def check_thread(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # threads don't survive uWSGI forking the workers, so each worker needs to start its own
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, daemon=True).start()
+
+    def drain(self, conn):
+        """Sends all commands that are due. Returns the number of seconds until the next command is due, or `None` if there's none."""
+        while True:
+            with conn.cursor() as cur:
+                cur.execute('BEGIN')
+                try:
+                    cur.execute('SELECT id, command, enqueued, attempts FROM discord_outbox WHERE next_attempt <= NOW() ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED')
+                    row = cur.fetchone()
+                    if row is None:
+                        cur.execute('SELECT EXTRACT(EPOCH FROM MIN(next_attempt) - NOW()) FROM discord_outbox WHERE next_attempt IS NOT NULL')
+                        wait, = cur.fetchone()
+                        cur.execute('COMMIT')
+                        return None if wait is None else max(0, float(wait))
+                    id, command, enqueued, attempts = row
+                    try:
+                        run(command)
+                    except Exception as e:
+                        attempts += 1
+                        if attempts >= MAX_ATTEMPTS:
+                            STATS['givenUp'] += 1
+                            cur.execute('UPDATE discord_outbox SET attempts = %s, next_attempt = NULL, last_error = %s WHERE id = %s', (attempts, str(e), id))
+                        else:
+                            STATS['retried'] += 1
+                            cur.execute('UPDATE discord_outbox SET attempts = %s, next_attempt = NOW() + %s, last_error = %s WHERE id = %s', (attempts, backoff(attempts), str(e), id))
+                    else:
+                        STATS['sent'] += 1
+                        STATS['latency'] += (datetime.datetime.now(datetime.timezone.utc) - enqueued).total_seconds()
+                        cur.execute('DELETE FROM discord_outbox WHERE id = %s', (id,))
+                    cur.execute('COMMIT')
+                except BaseException:
+                    cur.execute('ROLLBACK')
+                    raise
+
+    def run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn, application_name='gefolge-web-outbox')
+                conn.autocommit = True # transactions are managed by drain, so notifications are received between them
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {NOTIFY_CHANNEL}')
+                while True:
+                    wait = self.drain(conn)
+                    select.select([conn], [], [], 60 if wait is None else min(wait, 60))
+                    conn.poll()
+                    conn.notifies.clear()
+            except (psycopg2.Error, OSError, ValueError):
+                if conn is not None:
+                    conn.close()
+                time.sleep(5)
@@ -1,19 +1,36 @@
 import flask # PyPI: Flask
 
+API_KEYS = {} # maps API keys to the snowflakes of their users, verified against the user data on use since keys can be reset by other processes
+
 class Person:
     def __init__(self):
         raise TypeError('gefolge_web.person.Person cannot be instantiated directly')
 
     @staticmethod
     def by_api_key(key, *, exclude):
+        import gefolge_web.db
         import gefolge_web.login
 
-        for person in gefolge_web.login.DiscordPerson:
-            if person in exclude:
-                continue
+        def user_with_key(snowflake):
+            if snowflake is None:
+                return None
+            try:
+                person = gefolge_web.login.DiscordPerson(snowflake)
+            except FileNotFoundError:
+                return None # not in the guild
             if key == person.api_key_inner(create=False, exclude=exclude):
                 return person
 
+        person = user_with_key(API_KEYS.pop(key, None))
+        if person is None:
+            person = user_with_key(gefolge_web.db.BACKEND.user_id_by_api_key(key))
+            if person is None:
+                return None
+        API_KEYS[key] = person.snowflake
+        if person in exclude:
+            return None
+        return person
+
     @property
     def api_key(self):
         return self.api_key_inner(create=True)
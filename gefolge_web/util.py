@@ -3,6 +3,7 @@ import datetime
 import decimal
 import enum
 import functools
+import math
 import pathlib
 import re
 import subprocess
@@ -27,6 +28,7 @@ DEV_CHANNEL_ID = 397832322432499712
 DISCORD_EPOCH = 1420070400000
 EDIT_LOG = BASE_PATH / 'web.jlog'
 PARAGRAPH_RE = re.compile(r'(?:\r\n|\r|\n){2,}')
+TRANSACTIONS_PAGE_SIZE = 100
 
 CRASH_NOTICE = """An internal server error occurred on gefolge.org.
 User: {user}
@@ -178,42 +180,63 @@ class Transaction:
         })
 
     def __html__(self):
+        return self.render()
+
+    def __repr__(self):
+        return 'gefolge_web.util.Transaction({!r})'.format(self.json_data)
+
+    @property
+    def amount(self):
+        return Euro(self.json_data['amount'])
+
+    @property
+    def details(self):
+        return self.render_details()
+
+    def event(self, events=None):
+        """Returns the event this transaction is for, or `None` if it doesn't exist anymore. `events` may be a dict returned by `Event.resolve` to look the event up in."""
+        import gefolge_web.event.model
+
+        event_id = self.json_data['event']
+        if events is not None and event_id in events:
+            return events[event_id]
+        try:
+            return gefolge_web.event.model.Event(event_id)
+        except FileNotFoundError:
+            return None
+
+    def render(self, events=None):
+        """Returns the description of this transaction as HTML. `events` is passed to `event`."""
         if self.json_data['type'] == 'bankTransfer':
             return markupsafe.Markup('Überweisung')
         elif self.json_data['type'] == 'bar':
             return markupsafe.Markup('bar')
         elif self.json_data['type'] == 'eventAbrechnung':
-            import gefolge_web.event.model
-
-            try:
-                event = gefolge_web.event.model.Event(self.json_data['event'])
-            except FileNotFoundError:
+            event = self.event(events)
+            if event is None:
                 event = markupsafe.Markup('abgesagtes event <code>{}</code>'.format(markupsafe.escape(self.json_data['event'])))
             if 'guest' in self.json_data:
                 return markupsafe.Markup('Abrechnung von {} für {}'.format(event.__html__(), markupsafe.escape(event.person(self.json_data['guest']))))
             else:
                 return markupsafe.Markup('Abrechnung von {}'.format(event.__html__()))
         elif self.json_data['type'] == 'eventAnzahlung':
-            import gefolge_web.event.model
-
-            try:
-                event = gefolge_web.event.model.Event(self.json_data['event'])
-                if 'guest' in self.json_data:
-                    return markupsafe.Markup('Anzahlung für {} für {}'.format(event.__html__(), markupsafe.escape(event.person(self.json_data['guest']))))
-                else:
-                    return markupsafe.Markup('Anzahlung für {}'.format(event.__html__()))
-            except FileNotFoundError:
-                event = markupsafe.Markup('abgesagtes event <code>{}</code>'.format(markupsafe.escape(self.json_data['event'])))
-                if 'guest' in self.json_data:
-                    return markupsafe.Markup('Anzahlung für {} für einen Gast'.format(event.__html__()))
-                else:
-                    return markupsafe.Markup('Anzahlung für {}'.format(event.__html__()))
+            event = self.event(events)
+            if event is not None:
+                try:
+                    if 'guest' in self.json_data:
+                        return markupsafe.Markup('Anzahlung für {} für {}'.format(event.__html__(), markupsafe.escape(event.person(self.json_data['guest']))))
+                    else:
+                        return markupsafe.Markup('Anzahlung für {}'.format(event.__html__()))
+                except FileNotFoundError:
+                    pass
+            event = markupsafe.Markup('abgesagtes event <code>{}</code>'.format(markupsafe.escape(self.json_data['event'])))
+            if 'guest' in self.json_data:
+                return markupsafe.Markup('Anzahlung für {} für einen Gast'.format(event.__html__()))
+            else:
+                return markupsafe.Markup('Anzahlung für {}'.format(event.__html__()))
         elif self.json_data['type'] == 'eventAnzahlungReturn':
-            import gefolge_web.event.model
-
-            try:
-                event = gefolge_web.event.model.Event(self.json_data['event'])
-            except FileNotFoundError:
+            event = self.event(events)
+            if event is None:
                 event = markupsafe.Markup('abgesagtes event <code>{}</code>'.format(markupsafe.escape(self.json_data['event'])))
             return markupsafe.Markup('{}Rückzahlung der erhöhten Anzahlung für {}{}'.format('Teilweise ' if Euro(self.json_data['extraRemaining']) > Euro() else '', event.__html__(), ' (noch {})'.format(Euro(self.json_data['extraRemaining'])) if Euro(self.json_data['extraRemaining']) > Euro() else ''))
         elif self.json_data['type'] == 'payPal':
@@ -235,21 +258,15 @@ class Transaction:
         else:
             raise NotImplementedError('transaction type {} not implemented'.format(self.json_data['type']))
 
-    def __repr__(self):
-        return 'gefolge_web.util.Transaction({!r})'.format(self.json_data)
-
-    @property
-    def amount(self):
-        return Euro(self.json_data['amount'])
-
-    @property
-    def details(self):
-        import gefolge_web.event.model
-        import gefolge_web.login
+    def render_details(self, events=None):
+        """Returns the details of this transaction as HTML, to be appended to its description. `events` is passed to `event`."""
+        import gefolge_web.db
 
         if self.json_data['type'] == 'eventAbrechnung':
             if 'details' in self.json_data:
-                event = gefolge_web.event.model.Event(self.json_data['event'])
+                event = self.event(events)
+                if event is None:
+                    raise gefolge_web.db.not_found('events', self.json_data['event'])
                 return markupsafe.Markup(', Details:<br /><ul>\n{}\n</ul>'.format('\n'.join(
                     '<li>{}{}: {}</li>'.format(detail['label'], ' {}'.format(event.person(detail['snowflake']).__html__()) if 'snowflake' in detail else '', {
                         'flat': lambda detail: ('{} ({})'.format(Euro(detail['amount']), markupsafe.escape(detail['note'])) if 'note' in detail else '{}'.format(Euro(detail['amount']))),
@@ -268,12 +285,16 @@ class Transaction:
         return parse_iso_datetime(self.json_data['time'], tz=pytz.utc)
 
 def cached_json(file):
+    import gefolge_web.db
+
     try:
         if not hasattr(flask.g, 'json_cache'):
             flask.g.json_cache = {}
     except RuntimeError:
         return file
     else:
+        if isinstance(file, gefolge_web.db.PgFile):
+            return gefolge_web.db.BatchedFile(db_batch(), file)
         return lazyjson.CachedFile(flask.g.json_cache, file)
 
 def date_range(start, end):
@@ -282,6 +303,14 @@ def date_range(start, end):
         yield date
         date += datetime.timedelta(days=1)
 
+def db_batch():
+    """Returns the `gefolge_web.db.Batch` for the current request, which is flushed after the request is handled."""
+    import gefolge_web.db
+
+    if not hasattr(flask.g, 'db_batch'):
+        flask.g.db_batch = gefolge_web.db.Batch()
+    return flask.g.db_batch
+
 def format_number(n):
     if n == int(n):
         n = int(n) # remove trailing '.0'
@@ -316,6 +345,45 @@ def parse_iso_datetime(datetime_str, *, tz=pytz.timezone('Europe/Berlin')):
     else:
         return tz.localize(result, is_dst=None)
 
+def prefetch_json(table, ids=None):
+    """Loads the given rows (or the whole table if `ids` is `None`) in a single query and adds them to the cache used by `cached_json`. Returns the IDs of the rows that exist."""
+    import gefolge_web.db
+
+    rows = gefolge_web.db.PgFile.get_many(table, ids)
+    try:
+        batch = db_batch()
+    except RuntimeError:
+        pass
+    else:
+        for id, (value, version) in rows.items():
+            batch.prime(gefolge_web.db.PgFile(table, id), value, version)
+    return list(rows)
+
+def render_transactions(mensch, page=0):
+    """Renders a page of the transaction history of the given Mensch, newest first. The events referenced on the page are loaded in a single query beforehand.
+
+    Returns a list of (transaction, description, details) triples and the total number of pages.
+    """
+    import gefolge_web.event.model
+
+    transactions = mensch.transactions[::-1]
+    num_pages = max(1, math.ceil(len(transactions) / TRANSACTIONS_PAGE_SIZE))
+    transactions = transactions[page * TRANSACTIONS_PAGE_SIZE:(page + 1) * TRANSACTIONS_PAGE_SIZE]
+    events = gefolge_web.event.model.Event.resolve(
+        transaction.json_data['event']
+        for transaction in transactions
+        if 'event' in transaction.json_data
+    )
+    return [
+        (transaction, transaction.render(events), transaction.render_details(events))
+        for transaction in transactions
+    ], num_pages
+
+def rollback_db_batch():
+    """Discards writes made during the current request, since they might be incomplete."""
+    if hasattr(flask.g, 'db_batch'):
+        flask.g.db_batch.rollback()
+
 def render_template(template_name=None, **kwargs):
     if template_name is None:
         template_path = '{}.html.j2'.format(flask.request.endpoint.replace('.', '/'))
@@ -325,10 +393,15 @@ def render_template(template_name=None, **kwargs):
 
 def setup(app):
     for error_code in {403, 404}:
-        app.register_error_handler(error_code, lambda e: (render_template('error.{}'.format(error_code)), error_code))
+        def error_page(e, error_code=error_code):
+            rollback_db_batch()
+            return render_template('error.{}'.format(error_code)), error_code
+
+        app.register_error_handler(error_code, error_page)
 
     @app.errorhandler(500)
     def internal_server_error(e):
+        rollback_db_batch()
         try:
             user = str(flask.g.user)
         except Exception as e:
@@ -436,6 +509,18 @@ def setup(app):
     def vorstand(person):
         return person.is_vorstand
 
+    @app.after_request
+    def flush_db_batch(response):
+        import gefolge_web.db
+
+        if hasattr(flask.g, 'db_batch'):
+            try:
+                flask.g.db_batch.flush()
+            except gefolge_web.db.Conflict:
+                flask.g.db_batch.rollback()
+                return flask.make_response(render_template('error.409'), 409)
+        return response
+
     @app.before_request
     def current_time():
         flask.g.now = now()
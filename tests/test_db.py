@@ -0,0 +1,122 @@
+import os
+import time
+import timeit
+
+import pytest # PyPI: pytest
+import simplejson # PyPI: simplejson
+
+try:
+    import psycopg2 # PyPI: psycopg2
+except ImportError:
+    psycopg2 = None
+
+import gefolge_web.db
+
+DATABASE = os.environ.get('GEFOLGE_TEST_DATABASE') # DSN of a local Postgres database with the tables from assets, e.g. postgresql:///gefolge
+TEST_EVENT_ID = 'gefolge-web-test'
+
+requires_database = pytest.mark.skipif(DATABASE is None or psycopg2 is None, reason='GEFOLGE_TEST_DATABASE is not set or psycopg2 is not installed')
+
+class FakeBackend:
+    """A backend with a single user data row whose `patch_many` always raises the given exception."""
+
+    def __init__(self, exception):
+        self.exception = exception
+        self.patch_attempts = 0
+
+    def get(self, table, id):
+        return {'apiKey': 'abc123'}, 1
+
+    def get_many(self, table, ids=None):
+        return {str(id): self.get(table, id) for id in ids}
+
+    def patch_many(self, patches, outbox=()):
+        self.patch_attempts += 1
+        raise self.exception()
+
+@pytest.fixture
+def backend(monkeypatch, request):
+    backend = FakeBackend(request.param)
+    monkeypatch.setattr(gefolge_web.db, 'BACKEND', backend)
+    monkeypatch.setattr(gefolge_web.db, 'SHARED_CACHE', None)
+    return backend
+
+def set_api_key(batch):
+    file = gefolge_web.db.BatchedFile(batch, gefolge_web.db.PgFile('user-data', 1234))
+    file.set({'apiKey': 'def456'})
+
+@pytest.mark.parametrize('backend', [gefolge_web.db.Conflict], indirect=True)
+def test_flush_retries_conflicts(backend):
+    batch = gefolge_web.db.Batch()
+    set_api_key(batch)
+    with pytest.raises(gefolge_web.db.Conflict):
+        batch.flush()
+    assert backend.patch_attempts == gefolge_web.db.FLUSH_ATTEMPTS
+
+@pytest.mark.parametrize('backend', [gefolge_web.db.UniqueViolation], indirect=True)
+def test_flush_does_not_retry_unique_violations(backend):
+    batch = gefolge_web.db.Batch()
+    set_api_key(batch)
+    with pytest.raises(gefolge_web.db.UniqueViolation):
+        batch.flush()
+    assert backend.patch_attempts == 1
+
+def wait_for(condition, *, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(0.05)
+
+@pytest.fixture
+def test_event():
+    """Creates an event row for the test, and deletes it afterwards."""
+    backend = gefolge_web.db.PoolBackend(DATABASE)
+    backend.set('events', TEST_EVENT_ID, {'name': 'before'})
+    yield backend
+    backend.execute('DELETE FROM json_events WHERE id = %s', (TEST_EVENT_ID,))
+
+@requires_database
+@pytest.mark.skipif(not os.access(gefolge_web.db.BACK_PATH, os.X_OK), reason='gefolge-web-back is not installed')
+def test_benchmark_pool_backend(test_event):
+    # gefolge-web-back connects to its own configured database, so GEFOLGE_TEST_DATABASE should be the same one for the comparison to be fair
+    ids = test_event.list('events')[:20]
+    subprocess_backend = gefolge_web.db.SubprocessBackend()
+
+    def load_all(backend):
+        for id in ids:
+            backend.get('events', id)
+
+    pool_time = min(timeit.repeat(lambda: load_all(test_event), number=1, repeat=5))
+    subprocess_time = min(timeit.repeat(lambda: load_all(subprocess_backend), number=1, repeat=5))
+    print(f'loading {len(ids)} events: {pool_time * 1000:.1f}ms with the pool backend, {subprocess_time * 1000:.1f}ms with the subprocess backend')
+    assert pool_time < subprocess_time
+
+@requires_database
+def test_shared_cache_invalidated_by_other_connection(monkeypatch, test_event):
+    cache = gefolge_web.db.SharedCache(DATABASE)
+    monkeypatch.setattr(gefolge_web.db, 'BACKEND', test_event)
+    monkeypatch.setattr(gefolge_web.db, 'SHARED_CACHE', cache)
+    wait_for(lambda: cache.table_version('events') is not None) # starts the listener
+    file = gefolge_web.db.PgFile('events', TEST_EVENT_ID)
+    assert file.load()[0]['name'] == 'before'
+    assert cache.get(('events', TEST_EVENT_ID))[0]['name'] == 'before'
+    # write like the Discord bot or the Rust code would, without going through this process
+    conn = psycopg2.connect(DATABASE)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute('UPDATE json_events SET value = %s::jsonb WHERE id = %s', (simplejson.dumps({'name': 'after'}), TEST_EVENT_ID))
+    finally:
+        conn.close()
+
+    def invalidated():
+        try:
+            cache.get(('events', TEST_EVENT_ID))
+        except KeyError:
+            return True
+        else:
+            return False
+
+    wait_for(invalidated)
+    assert file.load()[0]['name'] == 'after'
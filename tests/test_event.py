@@ -0,0 +1,217 @@
+import datetime
+import decimal
+import itertools
+import math
+import timeit
+
+import flask # PyPI: Flask
+import hypothesis # PyPI: hypothesis
+import hypothesis.strategies # PyPI: hypothesis
+import markupsafe # PyPI: MarkupSafe
+import more_itertools # PyPI: more-itertools
+import pytz # PyPI: pytz
+
+import gefolge_web.db
+import gefolge_web.event
+import gefolge_web.event.programm
+import gefolge_web.util
+
+TIMEZONE = pytz.timezone('Europe/Berlin')
+
+class TimetableEvent:
+    """The parts of `gefolge_web.event.model.Event` used by `programm_table`."""
+
+    def __init__(self, start, end, calendar):
+        self.timezone = TIMEZONE
+        self.start = start
+        self.end = end
+        self.calendar = sorted(calendar)
+
+    @property
+    def nights(self):
+        return gefolge_web.util.date_range(self.start.date(), self.end.date())
+
+def old_anzahlung_refunds(anzahlung, ausfall, anzahlungen, guest_total):
+    """The refund loop `event_page` used before `anzahlung_refunds`, run against a dict mapping keys to [Anzahlung, counted] instead of the event data. `guest_total` is the sum of the Anzahlungen of guests, which count towards the total but aren't refunded."""
+    refunds = []
+    while True:
+        anzahlung_total = sum((iter_anzahlung for iter_anzahlung, counted in anzahlungen.values() if counted), guest_total)
+        anzahlung_extra = anzahlung_total - ausfall
+        if anzahlung_extra <= gefolge_web.util.Euro():
+            break
+        extra_anzahlungen = sorted(filter(lambda kv: kv[1] > anzahlung, (
+            (key, iter_anzahlung)
+            for key, (iter_anzahlung, _) in anzahlungen.items()
+        )), key=lambda kv: (kv[1] % anzahlung == gefolge_web.util.Euro(), (kv[1] - anzahlung_extra) % anzahlung != gefolge_web.util.Euro(), -kv[1]))
+        if len(extra_anzahlungen) == 0:
+            break
+        iter_key, iter_anzahlung = extra_anzahlungen[0]
+        if iter_anzahlung % anzahlung == gefolge_web.util.Euro() or (iter_anzahlung - anzahlung_extra) % anzahlung == gefolge_web.util.Euro():
+            amount = min(anzahlung_extra, iter_anzahlung - anzahlung)
+        else:
+            amount = min(anzahlung_extra, iter_anzahlung % anzahlung)
+        anzahlungen[iter_key][0] = iter_anzahlung - amount
+        refunds.append((iter_key, iter_anzahlung - amount - anzahlung, amount))
+    return refunds
+
+def euro(cents):
+    return gefolge_web.util.Euro(decimal.Decimal(cents) / 100)
+
+@hypothesis.given(
+    anzahlung=hypothesis.strategies.sampled_from([500, 1000, 1250, 2500, 5000]).map(euro),
+    ausfall=hypothesis.strategies.integers(min_value=0, max_value=100000).map(euro),
+    anzahlungen=hypothesis.strategies.lists(hypothesis.strategies.tuples(
+        hypothesis.strategies.integers(min_value=0, max_value=40000).map(euro),
+        hypothesis.strategies.booleans(),
+    ), max_size=8),
+    num_guests=hypothesis.strategies.integers(min_value=0, max_value=3),
+)
+def test_anzahlung_refunds_matches_old_loop(anzahlung, ausfall, anzahlungen, num_guests):
+    guest_total = anzahlung * num_guests
+    total = sum((iter_anzahlung for iter_anzahlung, counted in anzahlungen if counted), guest_total)
+    expected = old_anzahlung_refunds(anzahlung, ausfall, {
+        key: [iter_anzahlung, counted]
+        for key, (iter_anzahlung, counted) in enumerate(anzahlungen)
+    }, guest_total)
+    actual = gefolge_web.event.anzahlung_refunds(anzahlung, total - ausfall, [
+        (key, iter_anzahlung, counted)
+        for key, (iter_anzahlung, counted) in enumerate(anzahlungen)
+    ])
+    assert actual == expected
+
+def test_anzahlung_refunds_prefers_amounts_that_become_multiples():
+    # 60€ can become a multiple of 25€ by refunding the entire 10€, so it's refunded before the larger 80€
+    refunds = gefolge_web.event.anzahlung_refunds(euro(2500), euro(1000), [
+        ('a', euro(8000), True),
+        ('b', euro(6000), True),
+    ])
+    assert refunds == [('b', euro(2500), euro(1000))]
+
+def old_programm_table(event):
+    """The Programm timetable as computed by `event_programm` before `programm_table`, scanning the whole calendar for each cell."""
+    calendar = event.calendar
+    filled_until = None
+    snip_start = 0
+    snip_end = 24
+
+    def calendar_cell(date, hour):
+        nonlocal filled_until
+        nonlocal snip_start
+        nonlocal snip_end
+
+        timestamp = event.timezone.localize(datetime.datetime.combine(date, datetime.time(hour)), is_dst=None)
+        if filled_until is not None and filled_until > timestamp:
+            return ''
+        if timestamp < event.start or timestamp >= event.end:
+            return markupsafe.Markup('<td style="background-color: #666666;"></td>')
+        events_starting_now = [
+            calendar_event
+            for calendar_event in calendar
+            if calendar_event.start >= timestamp
+            and calendar_event.start < timestamp + datetime.timedelta(hours=1)
+            and calendar_event.end < calendar_event.start + datetime.timedelta(hours=24)
+        ]
+        if len(events_starting_now) == 0:
+            return markupsafe.Markup('<td></td>')
+        elif len(events_starting_now) == 1:
+            calendar_event = more_itertools.one(events_starting_now)
+            hours = math.ceil((min(calendar_event.end, event.timezone.localize(datetime.datetime.combine(date + datetime.timedelta(days=1), datetime.time()), is_dst=None)) - timestamp) / datetime.timedelta(hours=1))
+            filled_until = timestamp + datetime.timedelta(hours=hours)
+            if hour < 6 and hour + hours >= 6:
+                snip_start = 6
+                snip_end = 6
+            if snip_start < hour + hours < 6:
+                snip_start = hour + hours
+            if snip_end > hour >= 6:
+                snip_end = hour
+            return markupsafe.Markup('<td rowspan="{}" class="{}">{}{}</td>'.format(hours, calendar_event.css_class, calendar_event.__html__(), '<br />{}'.format(markupsafe.escape(calendar_event.subtitle)) if calendar_event.subtitle else ''))
+        else:
+            return markupsafe.Markup('<td class="danger">{} Programmpunkte</td>'.format(len(events_starting_now)))
+
+    table = {
+        date: {
+            hour: calendar_cell(date, hour)
+            for hour in range(24)
+        }
+        for date in itertools.chain(event.nights, [event.end.date()])
+    }
+    return table, snip_start, snip_end
+
+def calendar_event(uid, start, end):
+    return gefolge_web.event.programm.CalendarEvent(None, uid, uid, markupsafe.escape(uid), start, end)
+
+def localize(*args):
+    return TIMEZONE.localize(datetime.datetime(*args), is_dst=None)
+
+SILVESTER = TimetableEvent(localize(2024, 12, 29, 14), localize(2025, 1, 1, 14), [
+    calendar_event('neujahr', localize(2025, 1, 1), localize(2025, 1, 1, 1)),
+    calendar_event('endreinigung', localize(2025, 1, 1, 12), localize(2025, 1, 1, 14)),
+    calendar_event('abendessen-1', localize(2024, 12, 29, 19), localize(2024, 12, 29, 20, 30)),
+    calendar_event('abendessen-2', localize(2024, 12, 30, 19), localize(2024, 12, 30, 21)),
+    # two Programmpunkte starting within the same hour
+    calendar_event('werewolf', localize(2024, 12, 30, 21, 15), localize(2024, 12, 30, 23)),
+    calendar_event('magic', localize(2024, 12, 30, 21, 45), localize(2024, 12, 31, 1)),
+    # goes over 06:00
+    calendar_event('nachtwanderung', localize(2024, 12, 31, 4), localize(2024, 12, 31, 7)),
+    # lasts 24 hours, so it's not shown
+    calendar_event('marathon', localize(2024, 12, 29, 15), localize(2024, 12, 30, 15)),
+    # starts before the event
+    calendar_event('anreise', localize(2024, 12, 29, 10), localize(2024, 12, 29, 12)),
+])
+
+def test_programm_table_matches_old_table():
+    assert gefolge_web.event.programm_table(SILVESTER) == old_programm_table(SILVESTER)
+
+def test_programm_table_empty_calendar():
+    event = TimetableEvent(localize(2024, 6, 1, 12), localize(2024, 6, 3, 12), [])
+    table, snip_start, snip_end = gefolge_web.event.programm_table(event)
+    assert (snip_start, snip_end) == (0, 24)
+    assert table == old_programm_table(event)[0]
+
+@hypothesis.given(hypothesis.strategies.lists(hypothesis.strategies.tuples(
+    hypothesis.strategies.integers(min_value=-12 * 60, max_value=4 * 24 * 60), # start, in minutes after the start of the event
+    hypothesis.strategies.integers(min_value=15, max_value=30 * 60), # duration in minutes
+), max_size=12))
+def test_programm_table_matches_old_table_for_random_calendars(programm):
+    start = localize(2024, 6, 1, 12)
+    event = TimetableEvent(start, localize(2024, 6, 5, 12), [
+        calendar_event(f'programmpunkt-{i}', start + datetime.timedelta(minutes=offset), start + datetime.timedelta(minutes=offset + duration))
+        for i, (offset, duration) in enumerate(programm)
+    ])
+    assert gefolge_web.event.programm_table(event) == old_programm_table(event)
+
+class Attendee:
+    """The part of `gefolge_web.person.DiscordPerson` used by `Event.attendee_data`."""
+
+    def __init__(self, snowflake):
+        self.snowflake = snowflake
+
+def old_attendee_data(event, person):
+    """The linear scan `Event.attendee_data` used before `Event.attendee_index`."""
+    if 'menschen' in event.data:
+        for iter_data in event.data['menschen']:
+            if str(iter_data['id'].value()) == str(person.snowflake):
+                return iter_data
+
+def test_benchmark_attendee_data():
+    attendees = [Attendee(100000000000000000 + i) for i in range(200)]
+    with flask.Flask(__name__).test_request_context():
+        # prime the request's batch so the event is never loaded from the database
+        gefolge_web.util.db_batch().prime(gefolge_web.db.PgFile('events', 'benchmark'), {
+            'menschen': [
+                {'id': str(attendee.snowflake), 'name': f'Mensch {i}'}
+                for i, attendee in enumerate(attendees)
+            ],
+        }, 1)
+        event = gefolge_web.event.model.Event('benchmark', check_exists=False)
+        for attendee in attendees:
+            assert event.attendee_data(attendee).value() == old_attendee_data(event, attendee).value()
+
+        def look_up_all(attendee_data):
+            for attendee in attendees:
+                attendee_data(attendee)
+
+        index_time = min(timeit.repeat(lambda: look_up_all(event.attendee_data), number=1, repeat=5))
+        scan_time = min(timeit.repeat(lambda: look_up_all(lambda attendee: old_attendee_data(event, attendee)), number=1, repeat=5))
+    print(f'looking up {len(attendees)} attendees: {index_time * 1000:.1f}ms with the index, {scan_time * 1000:.1f}ms with a linear scan')
+    assert index_time < scan_time